@@ -0,0 +1,1260 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Atlas Tools
+
+Shared code of the atlas conversion scripts (convertDICOM.py, convertPNG.py,
+convertRAW.py, convertMyData.py) and the gradient atlas generator
+(gradientGenerator.py). Keep this file in the same folder as the scripts.
+It requires Python with PIL and numpy.
+
+Information links:
+http://www.volumerc.org
+http://demos.vicomtech.org
+Contact mailto:volumerendering@vicomtech.org
+"""
+import numpy as np
+from PIL import Image
+import contextlib
+import cProfile
+import errno
+import getopt
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import struct
+import sys
+import time
+import traceback
+import zlib
+
+##################
+# Atlas tiling   #
+##################
+def slicesPerAxis(numberOfSlices):
+    """Returns the number of slices on each axis of the square atlas"""
+    return int(math.ceil(math.sqrt(numberOfSlices)))
+
+def _atlasTiles(atlas):
+    """Returns a (row, column, X, Y[, C]) view of the tiles of a (rows, X, columns, Y[, C]) atlas array"""
+    return atlas.transpose((0, 2, 1, 3) + tuple(range(4, atlas.ndim)))
+
+def volumeToAtlas(volume):
+    """Tiles a (X, Y, Z) or (X, Y, Z, C) volume into a 2D atlas array of the same dtype.
+    Slice i is placed on tile row i/slicesPerAxis and tile column i%slicesPerAxis, the
+    tiles after the last slice are left to 0. The slices are copied with a single
+    reshape + transpose assignment for the complete rows and another one for the
+    partially filled last row."""
+    sizeX, sizeY, numberOfSlices = volume.shape[:3]
+    channels = volume.shape[3:]
+    perAxis = slicesPerAxis(numberOfSlices)
+    atlas = np.zeros((perAxis, sizeX, perAxis, sizeY) + channels, dtype=volume.dtype)
+    tiles = _atlasTiles(atlas)
+    slices = np.moveaxis(volume, 2, 0) # (Z, X, Y[, C]) view
+    fullRows = numberOfSlices // perAxis
+    tiles[:fullRows] = slices[:fullRows*perAxis].reshape((fullRows, perAxis, sizeX, sizeY) + channels)
+    if fullRows*perAxis < numberOfSlices:
+        tiles[fullRows, :numberOfSlices-fullRows*perAxis] = slices[fullRows*perAxis:]
+    return atlas.reshape((perAxis*sizeX, perAxis*sizeY) + channels)
+
+def tileSlices(slices, numberOfSlices):
+    """Tiles the 2D (or 2D + channels) arrays yielded by the slices iterable into an
+    atlas array, with the same layout as volumeToAtlas. The atlas is allocated using
+    the shape and dtype of the first slice."""
+    perAxis = slicesPerAxis(numberOfSlices)
+    atlas = None
+    for i, sliceData in enumerate(slices):
+        if atlas is None:
+            atlas = np.zeros((perAxis, sliceData.shape[0], perAxis, sliceData.shape[1]) + sliceData.shape[2:], dtype=sliceData.dtype)
+            tiles = _atlasTiles(atlas)
+        tiles[i // perAxis, i % perAxis] = sliceData
+    return atlas.reshape((perAxis*atlas.shape[1], perAxis*atlas.shape[3]) + atlas.shape[4:])
+
+def atlasSlices(atlas, numberOfSlices):
+    """Returns the slices of an atlas (array or PIL.Image) as a list of views of its tiles"""
+    atlas = np.asarray(atlas)
+    perAxis = slicesPerAxis(numberOfSlices)
+    tiles = _atlasTiles(atlas.reshape((perAxis, atlas.shape[0]//perAxis, perAxis, atlas.shape[1]//perAxis) + atlas.shape[2:]))
+    return [tiles[i // perAxis, i % perAxis] for i in range(numberOfSlices)]
+
+def _imageArray(filename, loadImgFunction, mode):
+    """Returns the image returned by loadImgFunction (a PIL.Image) as an array, converted to the given PIL mode"""
+    im = loadImgFunction(filename)
+    if im.mode != mode:
+        im = im.convert(mode)
+    return np.asarray(im)
+
+def _serialSlices(filenames, decodeFunction):
+    """Yields the arrays returned by decodeFunction for each file"""
+    numberOfSlices = len(filenames)
+    for i, filename in enumerate(filenames):
+        yield decodeFunction(filename)
+        progress("processed slice ", i+1, numberOfSlices)
+
+def _parallelSliceChunks(filenames, decodeFunction, jobs, chunkSize):
+    """Yields the arrays returned by decodeFunction for each file, decoded in parallel
+    (see decodeSlicesParallel) chunkSize files at a time"""
+    for start in range(0, len(filenames), chunkSize):
+        chunk = decodeSlicesParallel(filenames[start:start+chunkSize], decodeFunction, jobs, progressOffset=start, progressTotal=len(filenames))
+        for i in range(chunk.shape[2]):
+            yield chunk[:,:,i]
+
+def loadImageSlices(filenames, loadImgFunction, mode="L", jobs=1, cache=None, cacheKey=None, chunkSize=None):
+    """Returns an iterable of the images returned by loadImgFunction (a PIL.Image) for each
+    file as arrays, converted to the given PIL mode. With jobs > 1 the files are decoded
+    in parallel (see decodeSlicesParallel) before iterating, or chunkSize files at a time
+    when given (a row of tiles when streaming), so only a chunk is kept in memory. With a
+    ConversionCache the decoded volume is read from (or stored into) the cache under cacheKey."""
+    decodeFunction = lambda filename: _imageArray(filename, loadImgFunction, mode)
+    if cache is not None:
+        volume = cache.loadVolume(cacheKey)
+        if volume is None:
+            with stage('decode slices', fileBytes(filenames)) as record:
+                if jobs > 1:
+                    volume = decodeSlicesParallel(filenames, decodeFunction, jobs)
+                else:
+                    volume = np.stack(list(_serialSlices(filenames, decodeFunction)), axis=2)
+                record['bytesOut'] = volume.nbytes
+            cache.storeVolume(cacheKey, volume)
+        return (volume[:,:,i] for i in range(volume.shape[2]))
+    if jobs > 1 and chunkSize:
+        return _parallelSliceChunks(filenames, decodeFunction, jobs, chunkSize)
+    if jobs > 1:
+        with stage('decode slices', fileBytes(filenames)) as record:
+            volume = decodeSlicesParallel(filenames, decodeFunction, jobs)
+            record['bytesOut'] = volume.nbytes
+        return (volume[:,:,i] for i in range(volume.shape[2]))
+    return _serialSlices(filenames, decodeFunction)
+
+def peakMemoryMB():
+    """Returns the peak resident memory of the process in MB, or None where it is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes and macOS bytes
+    return peak / (1024.0*1024.0 if sys.platform == 'darwin' else 1024.0)
+
+#########################
+# Stage instrumentation #
+#########################
+class Instrumentation:
+    """Records the stages of a run: wall time, CPU time (of the process and its finished child
+    processes), bytes read and written and the peak memory of the process at the end of each stage"""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = []
+        self.depth = 0
+        self.startTime = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, bytesIn=0):
+        """Context manager recording a stage, yields its record (a dictionary) to set its 'bytesOut'.
+        The stages run inside another one are recorded with a greater 'depth'."""
+        record = {'stage':name, 'depth':self.depth, 'bytesIn':int(bytesIn), 'bytesOut':0}
+        self.stages.append(record)
+        self.depth += 1
+        startTime, startCPU = time.time(), sum(os.times()[:4])
+        try:
+            yield record
+        finally:
+            self.depth -= 1
+            record['seconds'] = round(time.time()-startTime, 4)
+            record['cpuSeconds'] = round(sum(os.times()[:4])-startCPU, 4)
+            record['peakMB'] = peakMemoryMB()
+
+    def report(self):
+        """Returns the recorded stages and the totals of the run as a dictionary"""
+        return {'seconds':round(time.time()-self.startTime, 4), 'cpuSeconds':round(sum(os.times()[:4]), 4),
+            'peakMB':peakMemoryMB(), 'stages':self.stages}
+
+    def printSummary(self):
+        """Prints a line for each recorded stage"""
+        for record in self.stages:
+            print "%-36s %8.2f s %8.2f s CPU %9.1f MB in %9.1f MB out, peak %s MB" % ("  "*record['depth']+record['stage'],
+                record.get('seconds', 0), record.get('cpuSeconds', 0), record['bytesIn']/1048576.0, record['bytesOut']/1048576.0,
+                "%.0f" % record['peakMB'] if record.get('peakMB') else "?")
+
+#The stages of the current run, see stage and runProfiled
+instrumentation = Instrumentation()
+
+def stage(name, bytesIn=0):
+    """Records a stage of the current run (see Instrumentation.stage)"""
+    return instrumentation.stage(name, bytesIn)
+
+def fileBytes(filenames):
+    """Returns the total size of the files"""
+    return sum(os.path.getsize(filename) for filename in filenames if os.path.isfile(filename))
+
+#Minimum seconds between two lines of progress output, 0 prints every step
+progressInterval = 1.0
+_progressTimes = {}
+
+def progress(label, done, total):
+    """Prints label : done/total, at most once every progressInterval seconds (and always the last step)"""
+    now = time.time()
+    if done >= total or now - _progressTimes.get(label, 0) >= progressInterval:
+        _progressTimes[label] = now
+        print label+" : "+str(done)+"/"+str(total)
+
+def runProfiled(function, reportFilename=None, dumpFilename=None):
+    """Runs function() recording its stages. With reportFilename the stages are printed and written
+    as a JSON report, with dumpFilename the cProfile statistics of the run are written to that file
+    (see the pstats module). Returns the result of function."""
+    instrumentation.reset()
+    profiler = cProfile.Profile() if dumpFilename else None
+    try:
+        return profiler.runcall(function) if profiler is not None else function()
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(dumpFilename)
+            print "cProfile statistics written to "+dumpFilename
+        if reportFilename:
+            instrumentation.printSummary()
+            with open(reportFilename, 'w') as f:
+                json.dump(instrumentation.report(), f, indent=1)
+            print "Profile report written to "+reportFilename
+
+##############################
+# Parallel work and decoding #
+##############################
+_forkedWorker = {}
+
+def _initForkedWorker(function, state):
+    """Pool initializer, keeps the task function and its state in the worker process"""
+    _forkedWorker['function'] = function
+    _forkedWorker['state'] = state
+
+def _runForkedTask(task):
+    return _forkedWorker['function'](_forkedWorker['state'], task)
+
+def forkedImap(function, tasks, jobs, state=None):
+    """Yields function(state, task) for each task, in completion order, computed by a pool
+    of jobs forked processes. The function and its state are inherited by the workers
+    instead of being pickled, so they can be closures, and numpy arrays allocated with
+    sharedVolume (or memory maps) in the state are shared with the main process."""
+    pool = multiprocessing.Pool(jobs, _initForkedWorker, (function, state))
+    try:
+        for result in pool.imap_unordered(_runForkedTask, tasks, max(1, len(tasks) // (4*jobs))):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def sharedVolume(shape, dtype):
+    """Returns a zero filled numpy array of the given shape and dtype allocated in shared
+    memory, processes forked after its creation write into the same memory"""
+    dtype = np.dtype(dtype)
+    sharedBuffer = multiprocessing.RawArray('b', int(np.prod(shape))*dtype.itemsize)
+    return np.frombuffer(sharedBuffer, dtype=dtype).reshape(shape)
+
+def _decodeSliceIntoVolume(state, task):
+    """Decodes one file and writes it at its slice index of the shared volume"""
+    volume, decodeFunction = state
+    index, filename = task
+    volume[:,:,index] = decodeFunction(filename)
+    return index
+
+def _decodeSlabIntoVolume(state, task):
+    """Decodes the files of the slices start to end (the first one is decoded by the main process)
+    into the shared volume, and returns the task and the brick grid of the slab (see brickSlabMinMax)"""
+    volume, decodeFunction, filenames, brickSize = state
+    start, end = task
+    for index in range(max(start, 1), end):
+        volume[:,:,index] = decodeFunction(filenames[index])
+    return task, brickSlabMinMax(volume[:,:,start:end], brickSize)
+
+def decodeSlicesParallel(filenames, decodeFunction, jobs, brickSize=None, progressOffset=0, progressTotal=None):
+    """Decodes each file with decodeFunction (returns a 2D or 2D + channels array) in a pool
+    of jobs processes and returns the (X, Y, Z[, C]) volume. The volume is allocated in
+    shared memory from the first slice, and each worker writes its slices directly at their
+    index, so no slice data is sent back to the main process. The result is the same as
+    decoding the files one after another. With brickSize, each worker decodes a slab of
+    brickSize slices and reduces its bricks right after (see brickMinMax), and the (volume,
+    brick minimums, brick maximums) tuple is returned. The files of a chunk of a longer sequence
+    are reported as the slices after progressOffset of its progressTotal slices."""
+    if brickSize:
+        return _decodeSlabsParallel(filenames, decodeFunction, jobs, brickSize)
+    first = decodeFunction(filenames[0])
+    numberOfSlices = len(filenames)
+    total = progressTotal or numberOfSlices
+    volume = sharedVolume(first.shape[:2] + (numberOfSlices,) + first.shape[2:], first.dtype)
+    volume[:,:,0] = first
+    progress("processed slice ", progressOffset+1, total)
+    if not hasattr(os, 'fork'):
+        print "Parallel decoding needs os.fork, decoding one slice after another..."
+        for i in range(1, numberOfSlices):
+            volume[:,:,i] = decodeFunction(filenames[i])
+            progress("processed slice ", progressOffset+i+1, total)
+        return volume
+    tasks = list(enumerate(filenames))[1:]
+    for done, _ in enumerate(forkedImap(_decodeSliceIntoVolume, tasks, jobs, (volume, decodeFunction)), 2):
+        progress("processed slice ", progressOffset+done, total)
+    return volume
+
+def _decodeSlabsParallel(filenames, decodeFunction, jobs, brickSize):
+    """decodeSlicesParallel with the brick grid reduced by the workers, one slab at a time"""
+    first = decodeFunction(filenames[0])
+    numberOfSlices = len(filenames)
+    volume = sharedVolume(first.shape[:2] + (numberOfSlices,) + first.shape[2:], first.dtype)
+    volume[:,:,0] = first
+    tasks = [(z, min(z+brickSize, numberOfSlices)) for z in range(0, numberOfSlices, brickSize)]
+    if not hasattr(os, 'fork'):
+        print "Parallel decoding needs os.fork, decoding one slice after another..."
+        results = [_decodeSlabIntoVolume((volume, decodeFunction, filenames, brickSize), task) for task in tasks]
+    else:
+        results, done = [], 0
+        for (start, end), grid in forkedImap(_decodeSlabIntoVolume, tasks, jobs, (volume, decodeFunction, filenames, brickSize)):
+            results.append(((start, end), grid))
+            done += end-start
+            progress("processed slice ", done, numberOfSlices)
+    grids = [grid for task, grid in sorted(results, key=lambda result: result[0])]
+    return (volume,) + tuple(np.stack([grid[i] for grid in grids], axis=2) for i in (0, 1))
+
+##########################
+# Streaming atlas output #
+##########################
+class PNGStreamWriter:
+    """Writes a PNG image a few rows at a time. The rows are filtered and compressed
+    as soon as they are given, so the whole image is never kept in memory.
+    Supported modes are L, RGB and RGBA (8 bits per channel), supported filters are
+    'none', 'sub', 'up' and 'adaptive' (the one of them with the smallest sum of absolute
+    differences for each row, the heuristic of the PNG specification)."""
+    COLOR_TYPES = {'L':(0, 1), 'RGB':(2, 3), 'RGBA':(6, 4)}
+    FILTERS = {'none':0, 'sub':1, 'up':2, 'adaptive':None}
+
+    def __init__(self, filename, width, height, mode='L', compressionLevel=6, pngFilter='up'):
+        colorType, self.channels = PNGStreamWriter.COLOR_TYPES[mode]
+        self.filterType = PNGStreamWriter.FILTERS[pngFilter]
+        self.width, self.height = width, height
+        self.rowsWritten = 0
+        self.seconds = 0.0 # time spent filtering, compressing and writing
+        self.previousRow = np.zeros(width*self.channels, dtype=np.uint8)
+        self.compressor = zlib.compressobj(compressionLevel)
+        self.file = open(filename, 'wb')
+        self.file.write('\x89PNG\r\n\x1a\n')
+        self._writeChunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, colorType, 0, 0, 0))
+
+    def _writeChunk(self, chunkType, data):
+        """Writes a PNG chunk: length, type, data and CRC"""
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunkType)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff))
+
+    def _filterRowsWith(self, rows, filterType):
+        """Returns the scanlines of a (rows, width*channels) uint8 array filtered with a filter type, each one preceded by its filter type byte"""
+        filtered = np.empty((rows.shape[0], rows.shape[1]+1), dtype=np.uint8)
+        filtered[:,0] = filterType
+        if filterType == 1:
+            filtered[:,1:self.channels+1] = rows[:,:self.channels]
+            np.subtract(rows[:,self.channels:], rows[:,:-self.channels], out=filtered[:,self.channels+1:])
+        elif filterType == 2:
+            np.subtract(rows[:1], self.previousRow, out=filtered[:1,1:])
+            np.subtract(rows[1:], rows[:-1], out=filtered[1:,1:])
+        else:
+            filtered[:,1:] = rows
+        return filtered
+
+    def _filterRows(self, rows):
+        """Returns the filtered scanlines of a (rows, width*channels) uint8 array, each one preceded by its filter type byte"""
+        if self.filterType is None:
+            candidates = np.stack([self._filterRowsWith(rows, filterType) for filterType in (0, 1, 2)])
+            costs = np.abs(candidates[:,:,1:].view(np.int8).astype(np.int32)).sum(axis=2)
+            filtered = candidates[np.argmin(costs, axis=0), np.arange(rows.shape[0])]
+        else:
+            filtered = self._filterRowsWith(rows, self.filterType)
+        self.previousRow = rows[-1].copy()
+        return filtered
+
+    def writeRows(self, rows):
+        """Compresses and writes a (rows, width[, channels]) uint8 array"""
+        if rows.shape[0] == 0:
+            return
+        startTime = time.time()
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape((rows.shape[0], self.width*self.channels))
+        compressed = self.compressor.compress(self._filterRows(rows).tostring())
+        self.rowsWritten += rows.shape[0]
+        if compressed:
+            self._writeChunk('IDAT', compressed)
+        self.seconds += time.time()-startTime
+
+    def close(self):
+        """Flushes the compressor and closes the file, missing rows are written as 0"""
+        if self.rowsWritten < self.height:
+            self.writeRows(np.zeros((self.height-self.rowsWritten, self.width*self.channels), dtype=np.uint8))
+        startTime = time.time()
+        self._writeChunk('IDAT', self.compressor.flush())
+        self._writeChunk('IEND', '')
+        self.bytesWritten = self.file.tell()
+        self.file.close()
+        self.seconds += time.time()-startTime
+
+def _tileSpans(size, tiles):
+    """Returns the first pixel and the number of pixels of each tile along an atlas axis of
+    size pixels divided in tiles tiles. A pixel belongs to the tile that contains its center."""
+    tileOfPixel = ((2*np.arange(size)+1)*tiles) // (2*size)
+    counts = np.bincount(tileOfPixel, minlength=tiles)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return starts, counts
+
+def _tileBoxWeights(size, newSize, tiles):
+    """Returns the (newSize, taps) source indices and weights of a box filter that resizes an
+    atlas axis from size to newSize pixels. Each destination pixel averages the source pixels
+    it covers inside its own tile, so the tiles never sample their neighbours."""
+    starts, counts = _tileSpans(size, tiles)
+    newStarts, newCounts = _tileSpans(newSize, tiles)
+    tile = np.repeat(np.arange(tiles), newCounts)
+    local = np.arange(newSize) - newStarts[tile]
+    scale = counts[tile] / newCounts[tile].astype(np.float64)
+    low, high = local*scale, (local+1)*scale
+    offsets = np.floor(low).astype(np.int64)[:,None] + np.arange(int(math.ceil(scale.max()))+1)
+    weights = (np.minimum(offsets+1, high[:,None]) - np.maximum(offsets, low[:,None])).clip(0)
+    weights /= weights.sum(axis=1)[:,None]
+    indices = starts[tile][:,None] + np.minimum(offsets, counts[tile][:,None]-1)
+    return indices, weights.astype(np.float32)
+
+def _boxFilterAxis(data, indices, weights, axis):
+    """Resamples data along axis with the indices and weights of _tileBoxWeights, as float32"""
+    shape = [1]*data.ndim
+    shape[axis] = indices.shape[0]
+    result = np.zeros(data.shape[:axis] + (indices.shape[0],) + data.shape[axis+1:], dtype=np.float32)
+    for tap in range(indices.shape[1]):
+        result += np.take(data, indices[:,tap], axis=axis) * weights[:,tap].reshape(shape)
+    return result
+
+class TileMipmapLevel:
+    """A dim x dim reduced version of an atlas of perAxis x perAxis tiles, computed with a
+    per tile box filter from the previous (larger) level one row of tiles at a time"""
+    def __init__(self, width, height, dim, perAxis):
+        self.dim = dim
+        self.rowIndices, self.rowWeights = _tileBoxWeights(height, dim, perAxis)
+        self.columnIndices, self.columnWeights = _tileBoxWeights(width, dim, perAxis)
+        self.sourceRowStarts, self.sourceRowCounts = _tileSpans(height, perAxis)
+        self.rowStarts, self.rowCounts = _tileSpans(dim, perAxis)
+
+    def reduceBand(self, band, tileRow):
+        """Returns the uint8 rows of tile row tileRow of this level, from the rows of the same
+        tile row of the previous level"""
+        rows = slice(self.rowStarts[tileRow], self.rowStarts[tileRow]+self.rowCounts[tileRow])
+        reduced = _boxFilterAxis(band, self.rowIndices[rows]-self.sourceRowStarts[tileRow], self.rowWeights[rows], 0)
+        reduced = _boxFilterAxis(reduced, self.columnIndices, self.columnWeights, 1)
+        return (reduced.clip(0, 255) + 0.5).astype(np.uint8)
+
+def mipmapLevels(width, height, perAxis, dimensions):
+    """Returns the TileMipmapLevel of each dimension smaller than the atlas width, from the
+    largest to the smallest. Each level is built from the previous one (or the full atlas)."""
+    levels = []
+    for dim in sorted(dimensions, reverse=True):
+        if width > dim:
+            levels.append(TileMipmapLevel(width, height, dim, perAxis))
+            width, height = dim, dim
+    return levels
+
+def reduceBandLevels(levels, band, tileRow):
+    """Yields the rows of tile row tileRow of each level, cascading from the full atlas band"""
+    for level in levels:
+        band = level.reduceBand(band, tileRow)
+        yield band
+
+def _pngMode(image):
+    """Returns the PIL mode of an uint8 (rows, columns[, channels]) image array"""
+    return {():'L', (3,):'RGB', (4,):'RGBA'}[image.shape[2:]]
+
+def _reportEncoded(filename, size, seconds):
+    """Prints the size and encoding time of a written png file"""
+    print "Encoded %s: %d bytes in %.2f s" % (filename, size, seconds)
+
+def encodePNG(image, filename, compressionLevel=6, pngFilter=None):
+    """Writes an uint8 image array as a png file with a zlib compression level (0-9).
+    With pngFilter None (or 'adaptive') it is encoded by PIL, which chooses the filter
+    of each row, with 'none', 'sub' or 'up' by PNGStreamWriter. Returns the file size in bytes."""
+    if pngFilter in (None, 'adaptive'):
+        Image.fromarray(image).save(filename, "PNG", compress_level=compressionLevel)
+        return os.path.getsize(filename)
+    writer = PNGStreamWriter(filename, image.shape[1], image.shape[0], _pngMode(image), compressionLevel, pngFilter)
+    for start in range(0, image.shape[0], 256):
+        writer.writeRows(image[start:start+256])
+    writer.close()
+    return writer.bytesWritten
+
+def saveImagesParallel(images, filenames, jobs=1, compressionLevel=6, pngFilter=None):
+    """Saves each image array as the png file of the same index (see encodePNG), encoding up
+    to jobs images at a time in a pool of threads (zlib and the PIL encoder release the GIL).
+    Reports the size and encoding time of each file, or the error (with its traceback) of the files
+    that could not be written. Returns the filenames that could not be written."""
+    def encode(task):
+        index, filename = task
+        startTime = time.time()
+        try:
+            size = encodePNG(images[index], filename, compressionLevel, pngFilter)
+        except Exception:
+            #Formatted in the thread that raised it, printed with the other results
+            return filename, None, 0, traceback.format_exc()
+        return filename, size, time.time()-startTime, None
+    tasks = list(enumerate(filenames))
+    with stage('png encode', sum(images[index].nbytes for index, filename in tasks)) as record:
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(jobs, len(tasks)))
+            results = pool.map(encode, tasks)
+            pool.close()
+        else:
+            results = map(encode, tasks)
+        record['bytesOut'] = sum(size for filename, size, seconds, error in results if size is not None)
+    for filename, size, seconds, error in results:
+        if size is not None:
+            _reportEncoded(filename, size, seconds)
+        else:
+            print "Could not write "+filename+":"
+            print error.rstrip()
+    return [filename for filename, size, seconds, error in results if size is None]
+
+def atlasVersions(atlas, dimensions=[8192,4096,2048,1024], perAxis=1):
+    """Returns the mipmapLevels of an uint8 atlas array of perAxis x perAxis tiles for the
+    given dimensions, and the images of the atlas followed by its reduced versions"""
+    height, width = atlas.shape[:2]
+    levels = mipmapLevels(width, height, perAxis, dimensions)
+    images = [atlas] + [np.empty((level.dim, level.dim) + atlas.shape[2:], dtype=np.uint8) for level in levels]
+    starts, counts = _tileSpans(height, perAxis)
+    for tileRow in range(perAxis):
+        band = atlas[starts[tileRow]:starts[tileRow]+counts[tileRow]]
+        for level, image, levelBand in zip(levels, images[1:], reduceBandLevels(levels, band, tileRow)):
+            image[level.rowStarts[tileRow]:level.rowStarts[tileRow]+level.rowCounts[tileRow]] = levelBand
+    return levels, images
+
+def writeAtlasVersions(atlas, outputFilename, dimensions=[8192,4096,2048,1024], perAxis=1, jobs=1, fullSuffix="_full", compressionLevel=6, pngFilter=None):
+    """Writes an uint8 atlas (array or PIL.Image) of perAxis x perAxis tiles as a png file
+    named outputFilename+fullSuffix+".png", and its reduced versions of the given dimensions
+    (see mipmapLevels). The images are encoded by jobs threads (see saveImagesParallel).
+    Returns the filenames that could not be written."""
+    atlas = np.asarray(atlas)
+    with stage('atlas versions', atlas.nbytes) as record:
+        levels, images = atlasVersions(atlas, dimensions, perAxis)
+        record['bytesOut'] = sum(image.nbytes for image in images[1:])
+    filenames = [outputFilename+fullSuffix+".png"] + [outputFilename+"_"+str(level.dim)+".png" for level in levels]
+    print "Writing complete image: "+filenames[0]
+    for level, filename in zip(levels, filenames[1:]):
+        print "Writing "+str(level.dim)+"x"+str(level.dim)+" version: "+filename
+    return saveImagesParallel(images, filenames, jobs, compressionLevel, pngFilter)
+
+def atlasRange(volume):
+    """Returns the minimum and maximum values of the atlas of a volume, including the empty tiles"""
+    cmin, cmax = volume.min(), volume.max()
+    if slicesPerAxis(volume.shape[2])**2 > volume.shape[2]:
+        cmin, cmax = min(cmin, 0), max(cmax, 0)
+    return cmin, cmax
+
+def byteScale(data, cmin, cmax):
+    """Scales the data from the [cmin, cmax] range to uint8 as scipy.misc.bytescale does,
+    uint8 data is returned unchanged"""
+    if data.dtype == np.uint8:
+        return data
+    scale = 255.0 / ((cmax - cmin) or 1)
+    scaled = ((data - cmin) * scale).clip(0, 255)
+    return (scaled + 0.5).astype(np.uint8)
+
+def writeAtlasStreaming(slices, numberOfSlices, outputFilename, dimensions=[8192,4096,2048,1024], fullSuffix="_full", jobs=1, compressionLevel=6, pngFilter=None):
+    """Writes the atlas of the uint8 slices yielded by the slices iterable as a png file named
+    outputFilename+fullSuffix+".png", and the reduced versions of the given dimensions, with
+    the same result as writeAtlasVersions. The atlas and its levels are built one row of tiles
+    at a time, so the memory used is bounded by a row of tiles instead of the whole atlas.
+    The rows of the images are encoded by jobs threads, with the 'up' filter by default.
+    An image that can not be written is reported with its error and the others are still written
+    (see saveImagesParallel). Returns the filenames that could not be written."""
+    filenames, writers, errors = [], [], {}
+    with stage('stream atlas') as record:
+        perAxis = slicesPerAxis(numberOfSlices)
+        band = None
+        pool = multiprocessing.pool.ThreadPool(jobs) if jobs > 1 and dimensions else None
+        completed = False
+        try:
+            for i, sliceData in enumerate(slices):
+                if band is None:
+                    sizeX, sizeY = sliceData.shape[:2]
+                    channels = sliceData.shape[2:]
+                    mode = _pngMode(sliceData)
+                    band = np.zeros((sizeX, perAxis, sizeY) + channels, dtype=np.uint8)
+                    bandRows = band.reshape((sizeX, perAxis*sizeY) + channels)
+                    width, height = perAxis*sizeY, perAxis*sizeX
+                    levels = mipmapLevels(width, height, perAxis, dimensions)
+                    filenames = [outputFilename+fullSuffix+".png"] + [outputFilename+"_"+str(level.dim)+".png" for level in levels]
+                    print "Writing complete image: "+filenames[0]
+                    for level, filename in zip(levels, filenames[1:]):
+                        print "Writing "+str(level.dim)+"x"+str(level.dim)+" version: "+filename
+                    sizes = [(width, height)] + [(level.dim, level.dim) for level in levels]
+                    writers = [_streamWriterCall(errors, filename, None, PNGStreamWriter, filename, size[0], size[1], mode, compressionLevel, pngFilter or 'up')
+                        for filename, size in zip(filenames, sizes)]
+                band[:, i % perAxis] = sliceData
+                record['bytesIn'] += sliceData.nbytes
+                if i % perAxis == perAxis-1 or i == numberOfSlices-1:
+                    _writeBandLevels(writers, filenames, errors, levels, bandRows, i // perAxis, pool)
+                    band[:] = 0
+            #Tile rows after the last slice are empty
+            for row in range((numberOfSlices+perAxis-1) // perAxis, perAxis):
+                _writeBandLevels(writers, filenames, errors, levels, bandRows, row, pool)
+            completed = True
+        finally:
+            if pool is not None:
+                pool.close()
+            for filename, writer in zip(filenames, writers):
+                if writer is None or filename in errors:
+                    continue
+                if completed:
+                    _streamWriterCall(errors, filename, writer, writer.close)
+                else:
+                    #The slices could not be read, the files are left incomplete
+                    writer.file.close()
+        for filename, writer in zip(filenames, writers):
+            if filename not in errors:
+                record['bytesOut'] += writer.bytesWritten
+                _reportEncoded(filename, writer.bytesWritten, writer.seconds)
+    for filename in filenames:
+        if filename in errors:
+            print "Could not write "+filename+":"
+            print errors[filename].rstrip()
+    return [filename for filename in filenames if filename in errors]
+
+def _streamWriterCall(errors, filename, writer, function, *args):
+    """Returns function(*args) for the PNGStreamWriter of filename (None while it is created), unless it
+    already failed. If it raises, the traceback is recorded in errors under filename and its file is closed."""
+    if filename in errors:
+        return None
+    try:
+        return function(*args)
+    except Exception:
+        errors[filename] = traceback.format_exc()
+        if writer is not None:
+            writer.file.close()
+        return None
+
+def _writeBandLevels(writers, filenames, errors, levels, bandRows, tileRow, pool=None):
+    """Writes a row of tiles of the full atlas and of each of its levels, in a pool of threads if given.
+    The writers that fail are recorded in errors (see _streamWriterCall) and skipped."""
+    bands = [bandRows] + list(reduceBandLevels(levels, bandRows, tileRow))
+    calls = [(filename, writer, band) for filename, writer, band in zip(filenames, writers, bands) if filename not in errors]
+    write = lambda (filename, writer, band): _streamWriterCall(errors, filename, writer, writer.writeRows, band)
+    if pool is not None:
+        pool.map(write, calls)
+    else:
+        for call in calls:
+            write(call)
+
+############################
+# Volume levels of detail  #
+############################
+def _halveAxis(data, axis):
+    """Sums the pairs of elements along axis, the last element of an odd axis is paired with itself"""
+    size = data.shape[axis]
+    return np.take(data, np.arange(0, size, 2), axis=axis) + np.take(data, np.minimum(np.arange(1, size+1, 2), size-1), axis=axis)
+
+def _halvePair(first, second):
+    """Returns the 2x2x2 box average of two consecutive slices, in the dtype of the slices"""
+    plane = first.astype(np.float32) + second
+    halved = _halveAxis(_halveAxis(plane, 0), 1) / 8
+    if np.issubdtype(first.dtype, np.integer):
+        halved = np.floor(halved + 0.5)
+    return halved.astype(first.dtype)
+
+def halveSlices(slices):
+    """Yields the slices of the volume given by the slices iterable halved along X, Y and Z,
+    each voxel being the average of a 2x2x2 block (odd sizes repeat their last voxel).
+    Only two slices of the input are needed at a time."""
+    previous = None
+    for sliceData in slices:
+        if previous is None:
+            previous = sliceData
+        else:
+            yield _halvePair(previous, sliceData)
+            previous = None
+    if previous is not None:
+        yield _halvePair(previous, previous)
+
+def teeHalvedSlices(slices, halved):
+    """Yields the slices of the slices iterable unchanged, appending the slices of the
+    halved volume (see halveSlices) to the halved list as they are completed"""
+    previous = None
+    for sliceData in slices:
+        yield sliceData
+        if previous is None:
+            previous = sliceData
+        else:
+            halved.append(_halvePair(previous, sliceData))
+            previous = None
+    if previous is not None:
+        halved.append(_halvePair(previous, previous))
+
+def writeAtlasDim(filename, numberOfSlices, url=None):
+    """Writes the atlas dimensions text file of an atlas of numberOfSlices slices: the
+    (total slices, slices per axis) tuple and the x3dom ImageTextureAtlas node to load it"""
+    perAxis = slicesPerAxis(numberOfSlices)
+    with open(filename, 'w') as f:
+        f.write(str((numberOfSlices,(perAxis,perAxis))))
+        f.write('\n')
+        f.write('<ImageTextureAtlas '+('url="'+url+'" ' if url else '')+'numberOfSlices="'+str(numberOfSlices)+'" slicesOverX="'+str(perAxis)+'" slicesOverY="'+str(perAxis)+'"></ImageTextureAtlas>\n')
+
+def writeCropFile(filename, box):
+    """Writes the JSON file of the crop offset and size of a box given by boundingBox, along the rows,
+    columns and slices of the arrays, in PIL order (width, height, slices). Returns the offset and size."""
+    (y0, y1), (x0, x1), (z0, z1) = box
+    offset, size = [x0, y0, z0], [x1-x0, y1-y0, z1-z0]
+    with open(filename, 'w') as f:
+        json.dump({'offset':offset, 'size':size}, f, indent=1, sort_keys=True)
+    return offset, size
+
+def writeLevelsOfDetail(halvedSlices, outputFilename, levels, jobs=1, compressionLevel=6, pngFilter=None):
+    """Writes up to levels levels of detail of a volume, given the slices of its first halved
+    level. Level k is the volume halved k times along X, Y and Z, tiled into its own atlas
+    outputFilename+"_lodk.png" with its outputFilename+"_lodk_AtlasDim.txt" dimensions file.
+    Stops when the volume can not be halved any more. Returns the filenames that could not be written."""
+    with stage('levels of detail') as record:
+        slices = list(halvedSlices)
+        record['bytesIn'] = sum(sliceData.nbytes for sliceData in slices)
+        images, filenames = [], []
+        for level in range(1, levels+1):
+            filename = outputFilename+"_lod"+str(level)
+            print "Writing level of detail "+str(level)+" "+str(slices[0].shape[:2]+(len(slices),))+": "+filename+".png"
+            images.append(tileSlices(slices, len(slices)))
+            filenames.append(filename+".png")
+            writeAtlasDim(filename+"_AtlasDim.txt", len(slices), os.path.basename(filename)+".png")
+            if min(slices[0].shape[:2]+(len(slices),)) == 1:
+                break
+            slices = list(halveSlices(slices))
+        failed = saveImagesParallel(images, filenames, jobs, compressionLevel, pngFilter)
+        record['bytesOut'] = fileBytes([filename for filename in filenames if filename not in failed])
+    return failed
+
+##############
+# Brick grid #
+##############
+def brickSlabMinMax(slab, brickSize=16):
+    """Returns the minimum and maximum values of the bricks of a (X, Y, k) slab of at most brickSize
+    slices, as two (ceil(X/brickSize), ceil(Y/brickSize)) arrays, with the reduceat of numpy.minimum
+    and numpy.maximum"""
+    slab = np.asarray(slab)
+    starts = [np.arange(0, size, brickSize) for size in slab.shape[:2]]
+    return tuple(reduction.reduce(reduction.reduceat(reduction.reduceat(slab, starts[0], axis=0), starts[1], axis=1), axis=2)
+        for reduction in (np.minimum, np.maximum))
+
+def brickMinMax(volume, brickSize=16):
+    """Returns the minimum and maximum values of each brickSize^3 block of voxels of a (X, Y, Z) volume
+    array, as two (ceil(X/brickSize), ceil(Y/brickSize), ceil(Z/brickSize)) arrays (the last bricks of an
+    axis are smaller). The volume is reduced one slab of brickSize slices at a time (see brickSlabMinMax),
+    so a memory mapped volume is read once without loading it."""
+    slabs = [brickSlabMinMax(volume[:,:,z:z+brickSize], brickSize) for z in range(0, volume.shape[2], brickSize)]
+    return tuple(np.stack([slab[i] for slab in slabs], axis=2) for i in (0, 1))
+
+################
+# Bounding box #
+################
+def volumeSlabs(volume, slabSize=16):
+    """Yields the consecutive slabs of slabSize slices along Z of a (X, Y, Z) volume array,
+    so a memory mapped volume is read once, one slab at a time"""
+    for z in range(0, volume.shape[2], slabSize):
+        yield np.asarray(volume[:,:,z:z+slabSize])
+
+def boundingBox(chunks, threshold=0):
+    """Returns the ((x0, x1), (y0, y1), (z0, z1)) bounds (end excluded) of the voxels with values above
+    threshold in the volume given by the chunks iterable: its consecutive (X, Y) slices or (X, Y, k) slabs
+    along Z (see volumeSlabs). Returns None if no voxel is above threshold. Only the reductions of each
+    chunk along the other axes are kept, so the volume is never needed in memory."""
+    xs, ys, zs = None, None, []
+    for chunk in chunks:
+        above = np.asarray(chunk) > threshold
+        if above.ndim == 2:
+            above = above[:,:,np.newaxis]
+        xs = above.any(axis=(1,2)) if xs is None else xs | above.any(axis=(1,2))
+        ys = above.any(axis=(0,2)) if ys is None else ys | above.any(axis=(0,2))
+        zs.extend(above.any(axis=(0,1)))
+    if not any(zs):
+        return None
+    return tuple((int(np.argmax(axis)), int(len(axis)-np.argmax(axis[::-1]))) for axis in (xs, ys, np.array(zs)))
+
+####################
+# Conversion cache #
+####################
+CACHE_VERSION = 1 # Change it when the cached results of the same parameters change
+
+class ConversionCache:
+    """A directory of cached conversion results, each one in a directory named by its key.
+    Keys are built from the input files (path, size and modification time, or their contents
+    with hashContents) and the conversion parameters, so a changed input or parameter never
+    matches an old entry. Two kinds of entries are kept: decoded volumes (.npy files, opened as
+    read-only memory maps) and the output files of a conversion. When the entries take more
+    than maxSizeMB, the least recently used ones are removed."""
+    def __init__(self, directory, maxSizeMB=4096, hashContents=False):
+        self.directory = directory
+        self.maxSize = int(maxSizeMB*1024*1024)
+        self.hashContents = hashContents
+        self.created = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, filenames, **parameters):
+        """Returns the key of the given input files and parameters"""
+        digest = hashlib.sha1(repr(CACHE_VERSION))
+        for filename in sorted(filenames):
+            info = os.stat(filename)
+            if self.hashContents:
+                contents = hashlib.sha1()
+                with open(filename, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), ''):
+                        contents.update(block)
+                digest.update(repr((os.path.basename(filename), info.st_size, contents.hexdigest())))
+            else:
+                digest.update(repr((os.path.abspath(filename), info.st_size, info.st_mtime)))
+        digest.update(repr(sorted(parameters.items())))
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        """Returns the directory of an entry, marking it as used, or None if it is not cached"""
+        entry = os.path.join(self.directory, key)
+        if not os.path.isdir(entry):
+            return None
+        os.utime(entry, None)
+        return entry
+
+    def _store(self, key, writeFunction):
+        """Creates the entry of key calling writeFunction(directory), the entry only appears when it is complete"""
+        entry = os.path.join(self.directory, key)
+        temporary = entry+'.tmp%d' % os.getpid()
+        os.makedirs(temporary)
+        try:
+            writeFunction(temporary)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(temporary, entry)
+        finally:
+            if os.path.isdir(temporary):
+                shutil.rmtree(temporary)
+        self.evict(keep=key)
+
+    def loadVolume(self, key, name='volume'):
+        """Returns the cached array (a volume, or the named array such as a gradient) of key as
+        a read-only memory map of its .npy file, or None"""
+        entry = self._entry(key)
+        if entry is None or not os.path.isfile(os.path.join(entry, name+'.npy')):
+            return None
+        print "Using the cached "+name+" "+key
+        return np.load(os.path.join(entry, name+'.npy'), mmap_mode='r')
+
+    def storeVolume(self, key, volume, name='volume'):
+        self._store(key, lambda directory: np.save(os.path.join(directory, name+'.npy'), volume))
+
+    def restoreOutputs(self, key, outputDirectory):
+        """Copies the cached output files of key into outputDirectory, returns False if they are not cached"""
+        entry = self._entry(key)
+        if entry is None or not os.path.isdir(os.path.join(entry, 'outputs')):
+            return False
+        outputs = os.path.join(entry, 'outputs')
+        for folder, _, files in os.walk(outputs):
+            destination = os.path.join(outputDirectory, os.path.relpath(folder, outputs))
+            if not os.path.isdir(destination):
+                os.makedirs(destination)
+            for name in files:
+                if name.endswith('.log'):
+                    continue
+                shutil.copyfile(os.path.join(folder, name), os.path.join(destination, name))
+                print "Restored cached output "+os.path.normpath(os.path.join(destination, name))
+        return True
+
+    @staticmethod
+    def isOutput(relative, prefixes):
+        """True if the path (relative to the output folder) is one of the prefixes or starts with a prefix
+        followed by '_' or '.', so the output 'a_series1' does not take the files of 'a_series10'.
+        Log files are not outputs, they may still be open (see batchConvert.py)."""
+        if relative.endswith('.log'):
+            return False
+        return any(relative == prefix or relative.startswith((prefix+'_', prefix+'.')) for prefix in prefixes)
+
+    def storeOutputs(self, key, outputDirectory, prefixes):
+        """Stores the files of outputDirectory that are outputs of the prefixes (see isOutput) and
+        that were modified after the cache was opened, as the outputs of key"""
+        since = int(self.created)
+        def copyOutputs(directory):
+            for folder, _, files in os.walk(outputDirectory):
+                for name in files:
+                    relative = os.path.relpath(os.path.join(folder, name), outputDirectory)
+                    if ConversionCache.isOutput(relative, prefixes) and os.path.getmtime(os.path.join(folder, name)) >= since:
+                        destination = os.path.join(directory, 'outputs', relative)
+                        if not os.path.isdir(os.path.dirname(destination)):
+                            os.makedirs(os.path.dirname(destination))
+                        shutil.copyfile(os.path.join(folder, name), destination)
+        self._store(key, copyOutputs)
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries (but keep) until the cache fits in its maximum size"""
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if os.path.isdir(entry) and '.tmp' not in key:
+                size = sum(os.path.getsize(os.path.join(folder, name)) for folder, _, files in os.walk(entry) for name in files)
+                entries.append((os.path.getmtime(entry), size, key))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if key != keep:
+                print "Removing the cache entry "+key
+                shutil.rmtree(os.path.join(self.directory, key))
+                total -= size
+
+##########################
+# DICOM series pre-scan  #
+##########################
+class DicomSeries:
+    """The files of one DICOM series in slice order, as found by scanDicomSeries, and the
+    problems found in their headers (errors), which prevent converting the series"""
+    def __init__(self, uid):
+        self.uid = uid
+        self.filenames = []
+        self.errors = []
+        self.sliceSize = None # (rows, columns)
+        self.spacing = None # distance between slices, if the files have their position
+
+def _readDicomHeader(state, filename):
+    """Returns the fields used to group and order a DICOM file, reading only its header"""
+    import dicom
+    try:
+        header = dicom.read_file(filename, stop_before_pixels=True, force=True)
+        fields = {'filename':filename, 'uid':str(header.get('SeriesInstanceUID', '')),
+            'size':(int(header.Rows), int(header.Columns))}
+    except Exception as e:
+        return {'filename':filename, 'error':str(e) or 'it is not a DICOM image'}
+    try:
+        fields['position'] = [float(v) for v in header.ImagePositionPatient]
+        fields['orientation'] = [float(v) for v in header.ImageOrientationPatient]
+    except Exception:
+        fields['position'] = fields['orientation'] = None
+    try:
+        fields['instance'] = int(header.InstanceNumber)
+    except Exception:
+        fields['instance'] = None
+    return fields
+
+def _orderSeries(series, headers):
+    """Sets the slice order of the series files and records the duplicated and missing slices.
+    Slices are ordered by their position along the slice normal, in the direction of increasing
+    instance numbers, or by instance number, or else by filename."""
+    headers = sorted(headers, key=lambda h: h['filename'])
+    sizes = sorted(set(h['size'] for h in headers))
+    series.sliceSize = sizes[0]
+    if len(sizes) > 1:
+        series.errors.append('slices of different sizes %s' % ', '.join('%dx%d' % s for s in sizes))
+    instances = [h['instance'] for h in headers]
+    if all(h['position'] is not None for h in headers):
+        orientation = np.array(headers[0]['orientation'])
+        normal = np.cross(orientation[:3], orientation[3:])
+        distances = [np.dot(normal, h['position']) for h in headers]
+        order = sorted(range(len(headers)), key=lambda i: (distances[i], instances[i]))
+        if None not in instances and len(headers) > 1 and instances[order[0]] > instances[order[-1]]:
+            order.reverse()
+        steps = np.abs(np.diff([distances[i] for i in order]))
+        positive = steps[steps > 1e-4]
+        series.spacing = float(np.median(positive)) if len(positive) else None
+        for i in np.nonzero(steps <= 1e-4)[0]:
+            series.errors.append('duplicated slice position %s (%s and %s)' % (headers[order[i]]['position'],
+                os.path.basename(headers[order[i]]['filename']), os.path.basename(headers[order[i+1]]['filename'])))
+        if series.spacing:
+            for i in np.nonzero(steps > 1.5*series.spacing)[0]:
+                series.errors.append('%d missing slice(s) between %s and %s' % (int(round(steps[i]/series.spacing))-1,
+                    os.path.basename(headers[order[i]]['filename']), os.path.basename(headers[order[i+1]]['filename'])))
+    elif None not in instances:
+        order = sorted(range(len(headers)), key=lambda i: instances[i])
+        for previous, current in zip(order[:-1], order[1:]):
+            if instances[current] == instances[previous]:
+                series.errors.append('duplicated instance number %d (%s and %s)' % (instances[current],
+                    os.path.basename(headers[previous]['filename']), os.path.basename(headers[current]['filename'])))
+            elif instances[current] > instances[previous]+1:
+                series.errors.append('%d missing slice(s) between instance numbers %d and %d' % (instances[current]-instances[previous]-1,
+                    instances[previous], instances[current]))
+    else:
+        order = range(len(headers))
+    series.filenames = [headers[i]['filename'] for i in order]
+
+def scanDicomSeries(filenames, jobs=1):
+    """Reads only the headers of the DICOM files (in jobs processes) and groups them by
+    SeriesInstanceUID. Returns the DicomSeries found, from the one with more files to the one
+    with less, and the files that could not be read as (filename, error) pairs."""
+    if jobs > 1 and len(filenames) > 1 and hasattr(os, 'fork'):
+        headers = list(forkedImap(_readDicomHeader, filenames, jobs))
+    else:
+        headers = [_readDicomHeader(None, filename) for filename in filenames]
+    unreadable = sorted((h['filename'], h['error']) for h in headers if 'error' in h)
+    groups = {}
+    for h in headers:
+        if 'error' not in h:
+            groups.setdefault(h['uid'], []).append(h)
+    seriesList = []
+    for uid, group in groups.items():
+        series = DicomSeries(uid)
+        _orderSeries(series, group)
+        seriesList.append(series)
+    seriesList.sort(key=lambda s: (-len(s.filenames), s.uid))
+    return seriesList, unreadable
+
+#############################
+# Slice conversion pipeline #
+#############################
+class SliceLoader:
+    """A slice file format of the converter scripts, see registerLoader"""
+    def __init__(self, name, loadImgFunction=None, extensions=(), options={}, usage=[], loaderFactory=None, selectFunction=None):
+        self.name = name
+        self.loadImgFunction = loadImgFunction
+        self.extensions = tuple(e.lower() for e in extensions)
+        self.options = dict(options)
+        self.usage = list(usage)
+        self.loaderFactory = loaderFactory
+        self.selectFunction = selectFunction
+
+    def accepts(self, filename):
+        """True if the file has one of the extensions of the format (any file without extensions)"""
+        return not self.extensions or filename.lower().endswith(self.extensions)
+
+    def parseOptions(self, pairs):
+        """Returns the format options given as (name, value) strings, converted to the type of their default
+        value. Raises a ValueError for an unknown option or a value of the wrong type."""
+        options = {}
+        for key, value in pairs:
+            if key not in self.options:
+                raise ValueError("Unknown "+self.name+" option "+key+", the options are: "+", ".join(sorted(self.options)))
+            try:
+                options[key] = int(value) if isinstance(self.options[key], int) else value
+            except ValueError:
+                raise ValueError("The "+self.name+" option "+key+" must be an integer, you typed: "+value)
+        return options
+
+    def loadFunction(self, options=None):
+        """Returns the function loading a slice file as a PIL.Image, built for the given format options"""
+        if self.loaderFactory is not None:
+            return self.loaderFactory(dict(self.options, **(options or {})))
+        return self.loadImgFunction
+
+    def selectSlices(self, filenames, options=None, jobs=1):
+        """Returns the files of the slices in tiling order (sorted by name by default), or None if
+        they can not be converted"""
+        if self.selectFunction is not None:
+            return self.selectFunction(filenames, dict(self.options, **(options or {})), jobs)
+        return sorted(filenames)
+
+#The slice formats by name, filled by the converter scripts (and loader plugins) with registerLoader
+sliceLoaders = {}
+
+def registerLoader(name, loadImgFunction=None, extensions=(), options={}, usage=[], loaderFactory=None, selectFunction=None):
+    """Registers a slice format for converterMain and gradientGenerator.py. Each slice is loaded as a
+    PIL.Image by loadImgFunction(filename), or by the function returned by loaderFactory(options) when
+    the format has options (a dictionary of default values, set with --name=value on the command line).
+    Only the files with the given extensions are read from a folder. selectFunction(filenames, options, jobs)
+    returns the files in slice order, or None if they can not be converted. usage lines describe the
+    input folder and the options. Returns the SliceLoader."""
+    loader = SliceLoader(name, loadImgFunction, extensions, options, usage, loaderFactory, selectFunction)
+    sliceLoaders[name] = loader
+    return loader
+
+def findLoader(filename):
+    """Returns the SliceLoader registered for the extension of a file, or None. The formats
+    without extensions accept any file, they are only used when selected by name."""
+    for name in sorted(sliceLoaders):
+        if sliceLoaders[name].extensions and sliceLoaders[name].accepts(filename):
+            return sliceLoaders[name]
+    return None
+
+def sliceStream(filenames, loadImgFunction, mode="L", jobs=1, transforms=(), cache=None, cacheKey=None, chunkSize=None):
+    """Returns the lazy iterable of the slices of the files as arrays (see loadImageSlices), each one
+    passed through the transforms in order (functions returning a new slice array)"""
+    slices = loadImageSlices(filenames, loadImgFunction, mode, jobs, cache, cacheKey, chunkSize)
+    for transform in transforms:
+        slices = itertools.imap(transform, slices)
+    return slices
+
+def makeOutputFolder(outputFilename):
+    """Creates the folder of outputFilename, reporting if it could not be created"""
+    try:
+        print 'Creating folder',os.path.dirname(outputFilename),'...',
+        os.makedirs(os.path.dirname(outputFilename))
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(os.path.dirname(outputFilename)):
+            print 'was already there.'
+        else:
+            print ', folders might not be created, trying to write anyways...'
+    except:
+        print ", could not create folders, trying to write anyways..."
+    else:
+        print
+
+def _cropSlices(filenames, loadImgFunction, jobs, transforms, cache, cacheKey, box):
+    """Returns the slices of the files cropped to the box given by boundingBox (see convertSlices)"""
+    (x0, x1), (y0, y1), (z0, z1) = box
+    transforms = tuple(transforms) + (lambda sliceData: sliceData[x0:x1, y0:y1],)
+    if cache is None:
+        return sliceStream(filenames[z0:z1], loadImgFunction, jobs=jobs, transforms=transforms, chunkSize=slicesPerAxis(z1-z0))
+    #The cached volume holds every slice of the files
+    return itertools.islice(sliceStream(filenames, loadImgFunction, jobs=jobs, transforms=transforms, cache=cache, cacheKey=cacheKey), z0, z1)
+
+def convertSlices(filenames, loadImgFunction, outputFilename, dimensions=[8192,4096,2048,1024], stream=False, jobs=1, lod=0, transforms=(), cache=None, cacheKey=None, compressionLevel=6, pngFilter=None, box=None):
+    """Slice pipeline of the converter scripts: the slices of the files (in the given order) go
+    through the transforms, are tiled and written as atlas versions (see writeAtlasVersions) and
+    lod levels of detail, png encoded with the compressionLevel and pngFilter of encodePNG.
+    With stream only one row of tiles (and the halved slices of the first level of detail) is
+    kept in memory, without the cache, and with jobs > 1 the slices are decoded a row at a time.
+    With a box given by boundingBox, the slices are cropped to it before tiling. Returns the
+    filenames not written."""
+    numberOfSlices = len(filenames) if box is None else box[2][1]-box[2][0]
+    perAxis = slicesPerAxis(numberOfSlices)
+    halved = []
+    if stream:
+        if box is None:
+            slices = sliceStream(filenames, loadImgFunction, jobs=jobs, transforms=transforms, chunkSize=perAxis)
+        else:
+            slices = _cropSlices(filenames, loadImgFunction, jobs, transforms, None, None, box)
+        if lod > 0:
+            slices = teeHalvedSlices(slices, halved)
+        failed = writeAtlasStreaming(slices, numberOfSlices, outputFilename, dimensions, jobs=jobs, compressionLevel=compressionLevel, pngFilter=pngFilter)
+    else:
+        with stage('load and tile slices', fileBytes(filenames)) as record:
+            if box is None:
+                slices = sliceStream(filenames, loadImgFunction, jobs=jobs, transforms=transforms, cache=cache, cacheKey=cacheKey)
+            else:
+                slices = _cropSlices(filenames, loadImgFunction, jobs, transforms, cache, cacheKey, box)
+            atlas = tileSlices(slices, numberOfSlices)
+            record['bytesOut'] = atlas.nbytes
+        failed = writeAtlasVersions(atlas, outputFilename, dimensions, perAxis, jobs, compressionLevel=compressionLevel, pngFilter=pngFilter)
+        if lod > 0:
+            halved = halveSlices(atlasSlices(atlas, numberOfSlices))
+    if lod > 0:
+        failed += writeLevelsOfDetail(halved, outputFilename, lod, jobs, compressionLevel, pngFilter)
+    return failed
+
+def converterMain(argv, loaderName, notes=[]):
+    """Command line of the converter scripts for the slice format registered as loaderName:
+    [options] [--stream] [--jobs=N] [--lod=N] [--crop=T] [--cache=DIR ...] [--profile=FILE] <InputFolder> <OutputFilename>.
+    Returns the exit status (None on success)."""
+    print "Parsing arguments..."
+    loader = sliceLoaders[loaderName]
+    common = ["stream", "jobs=", "lod=", "crop=", "cache=", "cache-size=", "cache-hash", "png-level=", "png-filter=", "profile=", "profile-dump="]
+    try:
+        opts, args = getopt.getopt(argv[1:], "", [key+"=" for key in sorted(loader.options)] + common)
+    except getopt.GetoptError as err:
+        print str(err)
+        opts, args = [], []
+    stream = ("--stream", "") in opts
+    try:
+        jobs = int(dict(opts).get("--jobs", 1))
+        lod = int(dict(opts).get("--lod", 0))
+        crop = int(dict(opts)["--crop"]) if "--crop" in dict(opts) else None
+        compressionLevel = int(dict(opts).get("--png-level", 6))
+        cacheSize = float(dict(opts).get("--cache-size", 4096))
+    except ValueError as err:
+        #Shows the usage, as a wrong option does
+        print "Wrong number in the options:", str(err)
+        opts, args = [], []
+        jobs, lod, crop, compressionLevel, cacheSize = 1, 0, None, 6, 4096
+    pngFilter = dict(opts).get("--png-filter")
+    if pngFilter not in (None,) + tuple(PNGStreamWriter.FILTERS):
+        print "The png filter must be one of "+", ".join(sorted(PNGStreamWriter.FILTERS))+", you typed:", pngFilter
+        return 2
+    try:
+        options = loader.parseOptions((opt[2:], value) for opt, value in opts if opt[2:] in loader.options)
+    except ValueError as err:
+        print str(err)
+        return 2
+    argv = [argv[0]] + args
+
+    if len(argv) < 3:
+        print "Usage: command "+("[options] " if loader.options else "")+"[--stream] [--jobs=N] [--lod=N] [--crop=T] [--cache=DIR [--cache-size=MB] [--cache-hash]] [--png-level=L] [--png-filter=F] [--profile=FILE [--profile-dump=FILE]] <InputFolder> <OutputFilename>"
+        for line in loader.usage:
+            print "	"+line
+        print "	<OutputFilename> must contain the path and base name of the desired output, extensions will be added automatically"
+        print "	--stream writes the output one row of slices at a time (loading them a row at a time with --jobs) instead of building the whole image in memory"
+        print "	--jobs=N loads the slices with N processes and encodes the output images with N threads"
+        print "	--lod=N also writes N levels of detail, each one halved along X, Y and Z with its own _AtlasDim.txt"
+        print "	--crop=T crops the slices to the bounding box of the pixels above T (0-255), read in a first pass over the slices,"
+        print "		its offset and size (width, height, slices) in the slices are written in the _crop.json file"
+        print "	--cache=DIR reuses the output (or the loaded slices) of a previous conversion of the same files and parameters kept in DIR,"
+        print "		--cache-size=MB bounds its size removing the least recently used entries, --cache-hash identifies the files by their contents"
+        print "	--png-level=L zlib compression level of the png files, from 0 (fastest) to 9 (smallest), 6 by default"
+        print "	--png-filter=F png row filter: none, sub, up or adaptive (the default, up when streaming)"
+        print "	--profile=FILE prints the time, CPU, bytes and peak memory of each stage and writes them to FILE as JSON,"
+        print "		--profile-dump=FILE also writes the cProfile statistics of the conversion to FILE (see the pstats module)"
+        for line in notes:
+            print line
+        print "You typed:", argv
+        return 2
+
+    def convert():
+        #Filter the files of the format in the given folder, in slice order
+        filenames = [os.path.join(argv[1], f) for f in os.listdir(argv[1]) if loader.accepts(f)]
+        if len(filenames) > 0:
+            with stage('select slices'):
+                filenames = loader.selectSlices(filenames, options, jobs)
+            if filenames is None:
+                return 2
+        if not filenames:
+            print "No "+loader.name+" files found in that folder, check your parameters or contact the authors :)."
+            return 2
+        loadImgFunction = loader.loadFunction(options)
+        print "Desired load function=", loadImgFunction.__name__
+
+        #Reuse the cached output if the same files were converted with the same parameters
+        cache, volumeKey = None, None
+        if "--cache" in dict(opts):
+            cache = ConversionCache(dict(opts)["--cache"], cacheSize, ("--cache-hash", "") in opts)
+            volumeKey = cache.key(filenames, loader=loader.name, options=sorted(dict(loader.options, **options).items()))
+            outputsKey = cache.key(filenames, volume=volumeKey, output=os.path.basename(argv[2]), dimensions=[8192,4096,2048,1024], lod=lod, crop=crop, pngLevel=compressionLevel, pngFilter=pngFilter)
+            if cache.restoreOutputs(outputsKey, os.path.dirname(argv[2]) or "."):
+                return 0
+
+        #Find the bounding box of the pixels above the crop threshold, reading the slices once more.
+        #When streaming the volume is not cached, it is reduced one slab (or row of tiles) at a time
+        box = None
+        if crop is not None:
+            with stage('bounding box', fileBytes(filenames)):
+                cached = cache.loadVolume(volumeKey) if stream and cache is not None else None
+                if cached is not None:
+                    chunks = volumeSlabs(cached)
+                elif stream:
+                    chunks = sliceStream(filenames, loadImgFunction, jobs=jobs, chunkSize=slicesPerAxis(len(filenames)))
+                else:
+                    chunks = sliceStream(filenames, loadImgFunction, jobs=jobs, cache=cache, cacheKey=volumeKey)
+                box = boundingBox(chunks, crop)
+            if box is None:
+                print "No pixel above the crop threshold",crop,"the slices are not cropped"
+            else:
+                print "Cropping the slices to the bounding box (start, end) along the width, height and slices:",(box[1],box[0],box[2])
+
+        #Write a text file containing the number of slices for reference
+        numberOfSlices = len(filenames) if box is None else box[2][1]-box[2][0]
+        perAxis = slicesPerAxis(numberOfSlices)
+        makeOutputFolder(argv[2])
+        try:
+            with open(argv[2]+"_AtlasDim.txt",'w') as f:
+                f.write(str((numberOfSlices,(perAxis,perAxis))))
+        except:
+            print "Could not write a text file",argv[2]+"_AtlasDim.txt","containing dimensions (total slices, slices per axis):",(numberOfSlices,(perAxis,perAxis))
+        else:
+            print "Created",argv[2]+"_AtlasDim.txt","containing dimensions (total slices, slices per axis):",(numberOfSlices,(perAxis,perAxis))
+        if box is not None:
+            try:
+                offset, size = writeCropFile(argv[2]+"_crop.json", box)
+            except IOError:
+                print "Could not write the crop offset and size (width, height, slices) file",argv[2]+"_crop.json"
+            else:
+                print "Created",argv[2]+"_crop.json","containing the crop offset and size (width, height, slices):",tuple(offset),tuple(size)
+
+        #Output is written in different sizes
+        for failed in convertSlices(filenames, loadImgFunction, argv[2], stream=stream, jobs=jobs, lod=lod, cache=cache, cacheKey=volumeKey, compressionLevel=compressionLevel, pngFilter=pngFilter, box=box):
+            print "Failed writing ",failed
+        if cache is not None:
+            cache.storeOutputs(outputsKey, os.path.dirname(argv[2]) or ".", [os.path.basename(argv[2])])
+
+    return runProfiled(convert, dict(opts).get("--profile"), dict(opts).get("--profile-dump"))
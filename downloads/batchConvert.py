@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batch Atlas Converter
+
+Walks a folder tree, finds every series (a folder of DICOM or PNG slices, or a
+nrrd file) and converts them with convertDICOM.py, convertPNG.py or, with
+--gradient, gradientGenerator.py. The series are run by a pool of worker
+processes forked from this one, so the packages are imported only once.
+A series only starts when its estimated memory fits in the --memory budget
+next to the series already running (a series larger than the budget runs
+alone). The output of each series is written to a log file next to its
+output, and a summary of every series is written to batchSummary.json.
+atlasTools.py and the conversion scripts must be in the same folder.
+
+Information links:
+http://www.volumerc.org
+http://demos.vicomtech.org
+Contact mailto:volumerendering@vicomtech.org
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shlex
+import sys
+import time
+import traceback
+from PIL import Image
+import atlasTools
+
+#The slice format each conversion script registers with atlasTools.registerLoader
+CONVERTER_FORMATS = {'convertDICOM':'DICOM', 'convertPNG':'PNG'}
+
+class Series:
+    """A volume to convert: a folder of slices or a nrrd file, the script that converts it
+    and the arguments of its main function"""
+    def __init__(self, path, kind, files, inputRoot, outputRoot, gradient, options, uid=None, suffix=''):
+        self.path = path
+        self.kind = kind # 'dicom', 'png' or 'nrrd'
+        self.files = files
+        self.uid = uid # SeriesInstanceUID of a dicom series, when the folder has more than one
+        relative = os.path.relpath(path, inputRoot)
+        name = os.path.splitext(os.path.basename(os.path.abspath(path)))[0]+suffix
+        if uid is not None:
+            options = options + ['--series='+uid]
+        folder = os.path.join(outputRoot, os.path.dirname(relative) if kind == 'nrrd' else relative)
+        if gradient:
+            self.tool = 'gradientGenerator'
+            self.argv = [self.tool, path, os.path.join(folder, name)+os.sep, name] + options
+            self.output = os.path.join(folder, name)
+        else:
+            self.tool = {'dicom':'convertDICOM', 'png':'convertPNG'}[kind]
+            self.argv = [self.tool] + options + [path, os.path.join(folder, name)]
+            self.output = os.path.join(folder, name)
+        self.logFilename = self.output+'.log'
+        self.memory = 0
+
+def findSeries(inputRoot, outputRoot, gradient=False, options=[]):
+    """Returns the Series found in the inputRoot folder tree. A folder with DICOM (or else PNG) files is a
+    series, and with gradient each nrrd file is one too (the conversion scripts do not read nrrd files).
+    The DICOM headers are read to split the folders with several series, numbered from the largest."""
+    series = []
+    for folder, folders, files in os.walk(inputRoot):
+        folders.sort()
+        dicomFiles = [os.path.join(folder, f) for f in sorted(files) if f.lower().endswith('.dcm')]
+        pngFiles = [os.path.join(folder, f) for f in sorted(files) if f.lower().endswith('.png')]
+        if dicomFiles:
+            dicomSeries = atlasTools.scanDicomSeries(dicomFiles)[0]
+            if len(dicomSeries) > 1:
+                for number, s in enumerate(dicomSeries, 1):
+                    series.append(Series(folder, 'dicom', s.filenames, inputRoot, outputRoot, gradient, options, s.uid, '_series%d' % number))
+            else:
+                series.append(Series(folder, 'dicom', dicomFiles, inputRoot, outputRoot, gradient, options))
+        elif pngFiles:
+            series.append(Series(folder, 'png', pngFiles, inputRoot, outputRoot, gradient, options))
+        if gradient:
+            for f in sorted(files):
+                if f.lower().endswith('.nrrd'):
+                    path = os.path.join(folder, f)
+                    series.append(Series(path, 'nrrd', [path], inputRoot, outputRoot, gradient, options))
+    return series
+
+def estimateVoxels(series):
+    """Returns the number of voxels of a series, read from the file headers when possible"""
+    try:
+        if series.kind == 'png':
+            width, height = Image.open(series.files[0]).size
+            return width*height*len(series.files)
+        elif series.kind == 'dicom':
+            import dicom
+            header = dicom.read_file(series.files[0], stop_before_pixels=True, force=True)
+            return int(header.Rows)*int(header.Columns)*len(series.files)
+        else:
+            import nrrd
+            with open(series.files[0], 'rb') as f:
+                sizes = nrrd.read_header(f)['sizes']
+            voxels = 1
+            for size in sizes:
+                voxels *= int(size)
+            return voxels
+    except Exception:
+        #16 bit samples, most DICOM and raw nrrd files
+        return sum(os.path.getsize(f) for f in series.files) // 2
+
+def _runSeries(series):
+    """Worker process: runs the main function of the series script with its output in the log file"""
+    if not os.path.isdir(os.path.dirname(series.logFilename)):
+        os.makedirs(os.path.dirname(series.logFilename))
+    log = open(series.logFilename, 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        result = __import__(series.tool).main(series.argv)
+    except BaseException:
+        traceback.print_exc()
+        result = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    #The scripts return None (or 0) on success
+    os._exit(0 if result is None else result if isinstance(result, int) and 0 <= result < 256 else 1)
+
+def runBatch(series, workers=1, memoryMB=None):
+    """Runs each series in its own forked process, up to workers at a time and, with memoryMB,
+    only while the estimated memory of the running series fits in it. Returns the summary
+    (a dictionary) of each series, in the same order."""
+    budget = memoryMB*1024*1024 if memoryMB else None
+    pending = list(range(len(series)))
+    running = {}
+    summaries = [None]*len(series)
+    while pending or running:
+        used = sum(series[i].memory for i in running)
+        admitted = [i for i in pending if len(running) < workers and (budget is None or not running or used+series[i].memory <= budget)][:1]
+        if admitted:
+            i = admitted[0]
+            pending.remove(i)
+            process = multiprocessing.Process(target=_runSeries, args=(series[i],))
+            process.start()
+            running[i] = (process, time.time())
+            continue
+        time.sleep(0.1)
+        for i, (process, start) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                del running[i]
+                summaries[i] = {'series':series[i].path, 'uid':series[i].uid, 'tool':series[i].tool, 'output':series[i].output,
+                    'log':series[i].logFilename, 'status':'ok' if process.exitcode == 0 else 'failed',
+                    'exitcode':process.exitcode, 'seconds':round(time.time()-start, 2),
+                    'estimatedMB':round(series[i].memory/(1024.0*1024.0), 1)}
+                print '[%d/%d] %s %s (%.1f s)' % (len([s for s in summaries if s]), len(series),
+                    summaries[i]['status'].upper(), series[i].path+(' '+series[i].uid if series[i].uid else ''), summaries[i]['seconds'])
+    return summaries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts every series (DICOM or PNG folder, nrrd file) of a folder tree into atlases')
+    parser.add_argument('input', type=str, help='The root folder of the series')
+    parser.add_argument('outputdir', type=str, help='The output root folder, each series is written in the same relative folder')
+    parser.add_argument('--gradient', action='store_true', help='Convert the series with gradientGenerator.py instead of convertDICOM.py/convertPNG.py')
+    parser.add_argument('--options', type=str, default='', help='Options passed to the conversion script of each series, e.g. --options="--lod=2"')
+    parser.add_argument('--workers', '-w', type=int, default=multiprocessing.cpu_count(), help='Number of series converted at the same time')
+    parser.add_argument('--memory', type=float, default=None, metavar='MB', help='Memory budget of the series running at the same time')
+    parser.add_argument('--voxel-bytes', type=float, default=None, help='Memory used per voxel of a series (default 4, 24 with --gradient, 48 with float64 gradients)')
+    arguments = parser.parse_args(argv[1:] if argv is not None else None)
+
+    options = shlex.split(arguments.options)
+    series = findSeries(arguments.input, arguments.outputdir, arguments.gradient, options)
+    if not series:
+        print 'No series found in '+arguments.input
+        return 2
+    voxelBytes = arguments.voxel_bytes
+    if voxelBytes is None:
+        #--precision float64 or --precision=float64 doubles the gradient memory
+        voxelBytes = (48 if any(option.endswith('float64') for option in options) else 24) if arguments.gradient else 4
+    for s in series:
+        s.memory = int(estimateVoxels(s)*voxelBytes)
+    print 'Found %d series, converting them with %d workers%s' % (len(series), arguments.workers,
+        ' within %.0f MB' % arguments.memory if arguments.memory else '')
+    #The scripts are imported once, before forking the workers. The converters must be the versions
+    #of this package, which register their slice format in atlasTools and take the arguments of main
+    for tool in sorted(set(s.tool for s in series)):
+        __import__(tool)
+        if tool in CONVERTER_FORMATS and CONVERTER_FORMATS[tool] not in atlasTools.sliceLoaders:
+            print '%s.py in %s does not register its slice format in atlasTools, use the version downloaded with batchConvert.py' % (tool,
+                os.path.dirname(os.path.abspath(sys.modules[tool].__file__)))
+            return 2
+
+    startTime = time.time()
+    summaries = runBatch(series, max(1, arguments.workers), arguments.memory)
+    failed = [s for s in summaries if s['status'] != 'ok']
+    if not os.path.isdir(arguments.outputdir):
+        os.makedirs(arguments.outputdir)
+    with open(os.path.join(arguments.outputdir, 'batchSummary.json'), 'w') as f:
+        json.dump({'seconds':round(time.time()-startTime, 2), 'series':summaries}, f, indent=1)
+    print '%d series converted, %d failed in %.1f s, summary written to %s' % (len(summaries)-len(failed), len(failed),
+        time.time()-startTime, os.path.join(arguments.outputdir, 'batchSummary.json'))
+    for s in failed:
+        print 'Failed: '+s['series']+' (see '+s['log']+')'
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
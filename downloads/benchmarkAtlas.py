@@ -0,0 +1,409 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Atlas conversion benchmark
+
+Times each stage of the converters and the gradient atlas generator on
+synthetic volumes written to a temporary folder (RAW and PNG slices, a small
+DICOM series, raw and nrrd volume files): slice loading, VolumeFileReader.loadFile,
+each gradient method, getAtlas/getGradientAtlas, the reduced atlas versions
+and the png encoding. Each stage runs in its own forked process, so the peak
+resident memory reported is the one of that stage. The results (MB/s and
+peak RSS of each stage) are written as JSON and compared with a baseline
+JSON file of a previous run, stages slower than the tolerance are reported
+as regressions. The fast paths are also checked against the legacy ones
+(slice loops, per pixel loaders, the non-table DICOM window/level), which
+must give byte-identical slices and atlases.
+atlasTools.py, the conversion scripts and gradientGenerator.py must be in the
+same folder. The DICOM and gradient stages need pydicom and the packages of
+gradientGenerator.py, they are skipped without them.
+
+Information links:
+http://www.volumerc.org
+http://demos.vicomtech.org
+Contact mailto:volumerendering@vicomtech.org
+"""
+import numpy as np
+import argparse
+import array
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import zlib
+from PIL import Image
+import atlasTools
+#The conversion scripts print their banner when imported
+sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+import convertRAW
+import convertPNG
+import convertDICOM
+sys.stdout = stdout
+
+GRADIENT_METHODS = ['gauss', 'sobel', 'prewitt', 'central-differences', 'forward-differences']
+
+#####################
+# Legacy references #
+#####################
+def loopAtlas(volume):
+    """Atlas tiling as done by VolumeData.getAtlas before atlasTools, one slice at a time"""
+    volumeSize = (volume.shape[0], volume.shape[1])
+    numberOfSlices = volume.shape[2]
+    slicesPerAxis = int(math.ceil(math.sqrt(numberOfSlices)))
+    atlasArray = np.zeros((volumeSize[0]*slicesPerAxis, volumeSize[1]*slicesPerAxis) + volume.shape[3:])
+    for i in range(0, numberOfSlices):
+        row = int((math.floor(i/slicesPerAxis)) * volumeSize[0])
+        col = int((i%slicesPerAxis) * volumeSize[1])
+        atlasArray[row:row+volumeSize[0], col:col+volumeSize[1]] = volume[:,:,i]
+    return atlasArray
+
+def legacyLoadRAW(filename, size):
+    """RAW slice loader of convertRAW.py before numpy (big endian uint16 values divided by 16),
+    one pixel at a time, for square slices of the given size"""
+    im = Image.new("L", (size, size))
+    putpix = im.im.putpixel
+    a = array.array("H")
+    with open(filename, "rb") as f:
+        a.fromfile(f, size*size)
+    if sys.byteorder == "little":
+        a.byteswap()
+    for y in range(size):
+        for x in range(size):
+            val = a[x+y*size] / 16
+            if val > 255:
+                val = 0
+            putpix((x,y), val)
+    return im
+
+###################
+# Synthetic input #
+###################
+def syntheticSlice(size, z, dtype, random):
+    """Returns slice z of a cubic volume: a smooth sphere with some noise, scaled to the
+    range of dtype (12 bits for uint16, as most CT data)"""
+    axis = np.linspace(-1.0, 1.0, size).astype(np.float32)
+    radius = np.sqrt(axis[:,None]**2 + axis[None,:]**2 + axis[z]**2)
+    data = np.clip(1.2 - radius, 0, 1) + 0.05*random.rand(size, size).astype(np.float32)
+    top = 255 if dtype == 'uint8' else 4095
+    return (np.clip(data, 0, 1)*top).astype(dtype)
+
+def syntheticVolume(size, dtype):
+    """Returns the (size, size, size) synthetic volume of the slices of syntheticSlice"""
+    random = np.random.RandomState(size)
+    volume = np.empty((size, size, size), dtype=dtype)
+    for z in range(size):
+        volume[:,:,z] = syntheticSlice(size, z, dtype, random)
+    return volume
+
+def writeDicomSeries(volume, folder, slices):
+    """Writes the first slices of an uint16 volume as a CT DICOM series, one file per slice"""
+    import dicom
+    from dicom.dataset import Dataset, FileDataset
+    filenames = []
+    for z in range(slices):
+        filename = os.path.join(folder, 'slice%04d.dcm' % z)
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        meta.MediaStorageSOPInstanceUID = '1.2.826.0.1.3680043.2.1125.1.%d' % z
+        meta.TransferSyntaxUID = '1.2.840.10008.1.2'
+        meta.ImplementationClassUID = '1.2.826.0.1.3680043.2.1125.3'
+        data = FileDataset(filename, {}, file_meta=meta, preamble='\0'*128)
+        data.is_little_endian, data.is_implicit_VR = True, True
+        data.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        data.SeriesInstanceUID = '1.2.826.0.1.3680043.2.1125.2'
+        data.Modality = 'CT'
+        data.InstanceNumber = z+1
+        data.ImagePositionPatient = [0, 0, z]
+        data.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        data.PixelSpacing = [1, 1]
+        data.Rows, data.Columns = volume.shape[:2]
+        data.SamplesPerPixel, data.PhotometricInterpretation = 1, 'MONOCHROME2'
+        data.BitsAllocated, data.BitsStored, data.HighBit, data.PixelRepresentation = 16, 16, 15, 0
+        data.RescaleIntercept, data.RescaleSlope = 0, 1
+        data.WindowCenter, data.WindowWidth = 500, 1500
+        data.PixelData = np.ascontiguousarray(volume[:,:,z]).astype('<u2').tostring()
+        data.save_as(filename)
+        filenames.append(filename)
+    return filenames
+
+def writeInputs(volume, folder, dicomSlices):
+    """Writes the synthetic volume in the input formats of the stages, returns their paths"""
+    inputs = {'raw':os.path.join(folder, 'raw'), 'png':os.path.join(folder, 'png'), 'dicom':os.path.join(folder, 'dicom'),
+        'volume':os.path.join(folder, 'volume.raw'), 'nrrd':os.path.join(folder, 'volume.nrrd')}
+    for name in ('raw', 'png', 'dicom'):
+        os.makedirs(inputs[name])
+    dtype = volume.dtype.name
+    with open(inputs['volume'], 'wb') as f:
+        for z in range(volume.shape[2]):
+            #RAW slices are big endian, as convertRAW.py reads them by default
+            volume[:,:,z].astype('>'+volume.dtype.str[1:]).tofile(os.path.join(inputs['raw'], 'slice%04d.raw' % z))
+            Image.fromarray(volume[:,:,z] if dtype == 'uint8' else (volume[:,:,z] >> 4).astype(np.uint8)).save(os.path.join(inputs['png'], 'slice%04d.png' % z))
+            np.ascontiguousarray(volume[:,:,z]).tofile(f)
+    if dtype == 'uint16':
+        try:
+            writeDicomSeries(volume, inputs['dicom'], min(dicomSlices, volume.shape[2]))
+        except ImportError:
+            del inputs['dicom']
+    else:
+        del inputs['dicom']
+    try:
+        import gradientGenerator
+        gradientGenerator.VolumeFileWriter.saveArrayAsNrrd(volume, inputs['nrrd'], dtype)
+    except ImportError:
+        del inputs['nrrd']
+    return inputs
+
+##########
+# Stages #
+##########
+def digest(arrays):
+    """Returns the sha1 of the values of the arrays"""
+    sha = hashlib.sha1()
+    for a in arrays:
+        sha.update(np.ascontiguousarray(a).tostring())
+    return sha.hexdigest()
+
+def pngDigest(filenames):
+    """Returns the sha1 of the decoded pixels of png files"""
+    return digest(np.asarray(Image.open(filename)) for filename in filenames)
+
+def readBinary(filename):
+    """Reads a --saveAs binary file back as a (X, Y, Z) or (X, Y, Z, C) array, following only its JSON header"""
+    with open(filename+'.json') as f:
+        header = json.load(f)
+    with open(filename, 'rb') as f:
+        f.seek(header['dataOffset'])
+        data = f.read()
+    if header['encoding'] == 'gzip':
+        data = zlib.decompress(data, 16+zlib.MAX_WBITS)
+    values = np.frombuffer(data, dtype=np.dtype(str(header['type'])).newbyteorder('<'))
+    x, y, z = header['shape']
+    if header['format'] == 'nrrd':
+        values = values.reshape((z, y, x, header['channels'])).transpose(2, 1, 0, 3)
+    else:
+        values = values.reshape((z, x, y, header['channels'])).transpose(1, 2, 0, 3)
+    return values if header['channels'] > 1 else values[...,0]
+
+def _runStage(connection, setup, function, repeat):
+    """Forked process of a stage: runs setup, then function(setup result) repeat times"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        state = setup() if setup is not None else None
+        best = None
+        for _ in range(repeat):
+            startTime = time.time()
+            result = function(state)
+            elapsed = time.time() - startTime
+            best = elapsed if best is None else min(best, elapsed)
+        connection.send((best, atlasTools.peakMemoryMB(), result, None))
+    except BaseException:
+        connection.send((None, atlasTools.peakMemoryMB(), None, traceback.format_exc()))
+    connection.close()
+    os._exit(0)
+
+def runStage(setup, function, repeat=1):
+    """Runs a stage in a forked process, returns its best time, peak RSS (MB), result and error"""
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_runStage, args=(child, setup, function, repeat))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+def volumeStages(size, dtype, inputs, volume, arguments):
+    """Returns the (name, megabytes, setup, function) stages of a synthetic volume and the
+    (name, reference name) pairs of stages that must give the same result"""
+    megaBytes = volume.nbytes / (1024.0*1024.0)
+    sliceFiles = lambda name: sorted(os.path.join(inputs[name], f) for f in os.listdir(inputs[name]))
+    rawOptions = dict(convertRAW.rawOptions, width=size, height=size, dtype=dtype, shift=4 if dtype == 'uint16' else 0)
+    legacySlices = min(arguments.legacy_slices, size)
+    stages = [
+        ('loadRAW', megaBytes, None, lambda state: digest(atlasTools.sliceStream(sliceFiles('raw'), convertRAW.rawLoader(rawOptions)))),
+        ('loadRAW jobs', megaBytes, None, lambda state: digest(atlasTools.sliceStream(sliceFiles('raw'), convertRAW.rawLoader(rawOptions), jobs=arguments.jobs))),
+        ('loadPNG', megaBytes/volume.dtype.itemsize, None, lambda state: digest(atlasTools.sliceStream(sliceFiles('png'), convertPNG.loadPNG))),
+        ('volumeToAtlas', megaBytes, lambda: volume, lambda state: digest([atlasTools.volumeToAtlas(state)])),
+        ('volumeToAtlas legacy', megaBytes, lambda: volume, lambda state: digest([loopAtlas(state).astype(volume.dtype)])),
+    ]
+    checks = [('loadRAW jobs', 'loadRAW'), ('volumeToAtlas', 'volumeToAtlas legacy')]
+    if dtype == 'uint16':
+        legacyMegaBytes = megaBytes*legacySlices/size
+        stages += [
+            ('loadRAW first slices', legacyMegaBytes, None, lambda state: digest(atlasTools.sliceStream(sliceFiles('raw')[:legacySlices], convertRAW.rawLoader(rawOptions)))),
+            ('loadRAW first slices legacy', legacyMegaBytes, None, lambda state: digest(atlasTools.sliceStream(sliceFiles('raw')[:legacySlices], lambda f: legacyLoadRAW(f, size)))),
+        ]
+        checks.append(('loadRAW first slices', 'loadRAW first slices legacy'))
+    if 'dicom' in inputs:
+        def loadDICOM(state, legacy=False):
+            if legacy:
+                convertDICOM.apply_LUT = convertDICOM.get_LUT_value
+            filenames = convertDICOM.selectDICOM(sliceFiles('dicom'), {'series':''})
+            return digest(atlasTools.sliceStream(filenames, convertDICOM.loadDICOM))
+        dicomMegaBytes = megaBytes*len(os.listdir(inputs['dicom']))/size
+        stages += [('loadDICOM', dicomMegaBytes, None, loadDICOM),
+            ('loadDICOM legacy', dicomMegaBytes, None, lambda state: loadDICOM(state, True))]
+        checks.append(('loadDICOM', 'loadDICOM legacy'))
+
+    #Atlas versions and png encoding of the 8 bit atlas
+    atlas8 = lambda: atlasTools.volumeToAtlas(volume if dtype == 'uint8' else (volume >> 4).astype(np.uint8))
+    perAxis = atlasTools.slicesPerAxis(size)
+    dimensions = [d for d in [8192,4096,2048,1024,512,256] if d < size*perAxis]
+    output = os.path.join(inputs['raw'], '..', 'output')
+    def encode(state, compressionLevel=6, pngFilter=None):
+        filenames = [output+'_%d.png' % i for i in range(len(state))]
+        failed = atlasTools.saveImagesParallel(state, filenames, arguments.jobs, compressionLevel, pngFilter)
+        return sum(os.path.getsize(f) for f in filenames if f not in failed)
+    def streamVersions(state):
+        slices = atlasTools.atlasSlices(state, size)
+        atlasTools.writeAtlasStreaming(iter(slices), size, output+'_stream', dimensions, jobs=arguments.jobs)
+        return pngDigest([output+'_stream_full.png'] + [output+'_stream_%d.png' % d for d in dimensions])
+    def memoryVersions(state):
+        atlasTools.writeAtlasVersions(state, output+'_memory', dimensions, perAxis, arguments.jobs)
+        return pngDigest([output+'_memory_full.png'] + [output+'_memory_%d.png' % d for d in dimensions])
+    stages += [
+        ('atlas versions', megaBytes/volume.dtype.itemsize, atlas8, lambda state: digest(atlasTools.atlasVersions(state, dimensions, perAxis)[1][1:])),
+        ('png encode', megaBytes/volume.dtype.itemsize, lambda: atlasTools.atlasVersions(atlas8(), dimensions, perAxis)[1], encode),
+        ('png encode level 1 up', megaBytes/volume.dtype.itemsize, lambda: atlasTools.atlasVersions(atlas8(), dimensions, perAxis)[1], lambda state: encode(state, 1, 'up')),
+        ('write atlas versions', megaBytes/volume.dtype.itemsize, atlas8, memoryVersions),
+        ('write atlas versions stream', megaBytes/volume.dtype.itemsize, atlas8, streamVersions),
+    ]
+    checks.append(('write atlas versions stream', 'write atlas versions'))
+
+    #Gradient generator stages
+    try:
+        import gradientGenerator
+    except ImportError:
+        return stages, checks
+    def readVolume(path, **options):
+        reader = gradientGenerator.VolumeFileReader(path)
+        reader.loadFile(**options)
+        return digest([reader.data])
+    def volumeData():
+        return gradientGenerator.VolumeData(volume, dtype)
+    def gradient(state, method, **options):
+        state.calculateGradientRGB(method, precision=np.float32, **options)
+        return digest([state.gradient])
+    stages += [
+        ('loadFile raw', megaBytes, None, lambda state: readVolume(inputs['volume'], imageSize=(size, size), numberOfSlices=size, dataType=dtype)),
+        ('loadFile raw mmap', megaBytes, None, lambda state: readVolume(inputs['volume'], imageSize=(size, size), numberOfSlices=size, dataType=dtype, memoryMap=True)),
+        ('loadFile png jobs', megaBytes/volume.dtype.itemsize, None, lambda state: readVolume(inputs['png'], jobs=arguments.jobs)),
+    ]
+    checks.append(('loadFile raw mmap', 'loadFile raw'))
+    if 'nrrd' in inputs:
+        stages.append(('loadFile nrrd', megaBytes, None, lambda state: readVolume(inputs['nrrd'])))
+        checks.append(('loadFile nrrd', 'loadFile raw'))
+    for method in GRADIENT_METHODS:
+        stages += [('gradient '+method, megaBytes, volumeData, lambda state, method=method: gradient(state, method)),
+            ('gradient '+method+' jobs', megaBytes, volumeData, lambda state, method=method: gradient(state, method, jobs=arguments.jobs, slabSize=max(1, size//4)))]
+        checks.append(('gradient '+method+' jobs', 'gradient '+method))
+    def gradientData():
+        data = volumeData()
+        data.calculateGradientRGB('gauss', precision=np.float32)
+        return data
+    stages += [('getAtlas', megaBytes, volumeData, lambda state: digest([state.getAtlas()])),
+        ('getGradientAtlas', megaBytes*3*4/volume.dtype.itemsize, gradientData, lambda state: digest([state.getGradientAtlas()]))]
+
+    #Binary outputs, read back following their JSON header
+    def saveBinary(state, f_format, compress):
+        filename = output+'_binary'+f_format+('.gz' if compress and f_format == '.raw' else '')
+        saveArray = gradientGenerator.VolumeFileWriter.saveArrayAsNrrd if f_format == '.nrrd' else gradientGenerator.VolumeFileWriter.saveArrayAsRaw
+        saveArray(volume, filename, dtype, compress)
+        return digest([readBinary(filename)])
+    stages.append(('binary reference', megaBytes, None, lambda state: digest([volume])))
+    for f_format in ('.raw', '.nrrd'):
+        for compress in (False, True):
+            name = 'saveBinary '+f_format[1:]+(' gzip' if compress else '')
+            stages.append((name, megaBytes, None, lambda state, f_format=f_format, compress=compress: saveBinary(state, f_format, compress)))
+            checks.append((name, 'binary reference'))
+    return stages, checks
+
+#########################
+# Results and baselines #
+#########################
+def compareBaseline(results, baseline, tolerance):
+    """Returns the (stage, MB/s, baseline MB/s) of the stages slower than the baseline by more than tolerance"""
+    regressions = []
+    for name, stage in sorted(results['stages'].items()):
+        previous = baseline.get('stages', {}).get(name)
+        if previous and previous.get('MBps') and stage.get('MBps') is not None and stage['MBps'] < previous['MBps']*(1.0-tolerance):
+            regressions.append((name, stage['MBps'], previous['MBps']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per stage benchmark of the atlas converters and the gradient generator on synthetic volumes')
+    parser.add_argument('sizes', type=int, nargs='*', default=[64, 128], help='Sizes of the synthetic cubic volumes (64 to 512)')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['uint8', 'uint16'], choices=['uint8', 'uint16'], help='Data types of the synthetic volumes')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each stage, the best time is reported')
+    parser.add_argument('--jobs', '-j', type=int, default=max(2, multiprocessing.cpu_count()), help='Number of processes or threads of the parallel stages')
+    parser.add_argument('--dicom-slices', type=int, default=32, help='Number of slices of the synthetic DICOM series')
+    parser.add_argument('--legacy-slices', type=int, default=4, help='Number of slices read by the per pixel legacy RAW loader')
+    parser.add_argument('--stages', type=str, nargs='+', default=None, help='Run only the stages whose name contains one of these words')
+    parser.add_argument('--output', '-o', type=str, default='benchmarkResults.json', help='JSON file of the results')
+    parser.add_argument('--baseline', '-b', type=str, default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown relative to the baseline reported as a regression')
+    parser.add_argument('--keep', type=str, default=None, metavar='DIR', help='Write the synthetic inputs and outputs in this folder and keep them')
+    arguments = parser.parse_args(argv)
+
+    results = {'platform':platform.platform(), 'python':platform.python_version(), 'numpy':np.__version__,
+        'cpus':multiprocessing.cpu_count(), 'jobs':arguments.jobs, 'repeat':arguments.repeat, 'stages':{}, 'checks':[]}
+    root = arguments.keep or tempfile.mkdtemp(prefix='benchmarkAtlas')
+    failed = []
+    try:
+        for size in arguments.sizes:
+            for dtype in arguments.dtypes:
+                prefix = '%d^3 %s ' % (size, dtype)
+                folder = os.path.join(root, '%d_%s' % (size, dtype))
+                if os.path.isdir(folder):
+                    shutil.rmtree(folder)
+                volume = syntheticVolume(size, dtype)
+                inputs = writeInputs(volume, folder, arguments.dicom_slices)
+                stages, checks = volumeStages(size, dtype, inputs, volume, arguments)
+                for name, megaBytes, setup, function in stages:
+                    if arguments.stages and not any(word in name for word in arguments.stages):
+                        continue
+                    seconds, peak, result, error = runStage(setup, function, arguments.repeat)
+                    stage = {'MB':round(megaBytes, 3), 'seconds':seconds, 'peakRSSMB':peak, 'result':result,
+                        'MBps':round(megaBytes/max(seconds, 1e-9), 2) if seconds is not None else None}
+                    results['stages'][prefix+name] = stage
+                    if error:
+                        failed.append(prefix+name)
+                        print '%-45s FAILED\n%s' % (prefix+name, error)
+                    else:
+                        print '%-45s %8.3f s %9.1f MB/s  peak RSS %s MB' % (prefix+name, seconds, stage['MBps'], '%.0f' % peak if peak else '?')
+                for name, reference in checks:
+                    if prefix+name in results['stages'] and prefix+reference in results['stages']:
+                        result = results['stages'][prefix+name]['result']
+                        same = result is not None and result == results['stages'][prefix+reference]['result']
+                        results['checks'].append({'stage':prefix+name, 'reference':prefix+reference, 'identical':same})
+                        if not same:
+                            failed.append(prefix+name)
+                        print '%-45s %s %s' % (prefix+name, 'identical to' if same else 'DIFFERENT from', reference)
+                del volume
+    finally:
+        if not arguments.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(arguments.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print 'Results written to '+arguments.output
+    regressions = []
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            regressions = compareBaseline(results, json.load(f), arguments.tolerance)
+        for name, speed, previous in regressions:
+            print 'Regression: %s %.1f MB/s, baseline %.1f MB/s (%.0f%% slower)' % (name, speed, previous, 100.0*(1.0-speed/previous))
+        print '%d regressions against %s' % (len(regressions), arguments.baseline)
+    return 1 if failed or regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,19 +4,18 @@ This code was created by Luis Kabongo, Vicomtech-IK4 Copyright 2012-2013.
 This application converts the slices found in a folder into a tiled 2D texture 
 image in PNG format (it assumes all files in the folder are of the same type 
 and dimensions). It uses Python with PIL, numpy and pydicom packages are 
-recommended for other formats.
+recommended for other formats. atlasTools.py must be in the same folder.
 Information links:
 http://www.volumerc.org
 http://demos.vicomtech.org
 Contact mailto:volumerendering@vicomtech.org
 """
 
-import os, errno
+import os
 import sys
-import getopt
-import math
 import array
 from PIL import Image #this is required to manage the images
+import atlasTools #this is required to build the atlas, keep atlasTools.py in the same folder
 
 #This is the default size when loading a Raw image
 sizeOfRaw = (512, 512)
@@ -39,6 +38,26 @@ def get_LUT_value(data, window, level,rescaleIntercept=0,rescaleSlope=1):
 		((data*rescaleSlope)+rescaleIntercept) > (level - 0.5 + (window-1)/2)],
 		[0, 255, lambda VAL: ((((VAL*rescaleSlope)+rescaleIntercept) - (level - 0.5))/(window-1) + 0.5)*(255-0)])
 
+#Lookup tables of apply_LUT, shared by all the slices with the same data type and parameters
+lookupTables = {}
+
+#This function returns the same values as get_LUT_value. For 8 and 16 bit integer data, get_LUT_value is computed
+#	once for every possible value of the data type (at most 65536) and the table is applied with numpy.take.
+#	Other data types (float, 32 bit integers) are mapped with get_LUT_value.
+def apply_LUT(data, window, level,rescaleIntercept=0,rescaleSlope=1):
+	if data.dtype.kind not in "iu" or data.dtype.itemsize > 2:
+		return get_LUT_value(data, window, level, rescaleIntercept, rescaleSlope)
+	#The table is indexed by the unsigned integer with the same bits as each value
+	unsigned = numpy.dtype("u"+str(data.dtype.itemsize))
+	key = (data.dtype.str, repr(window), repr(level), repr(rescaleIntercept), repr(rescaleSlope))
+	if key not in lookupTables:
+		values = numpy.arange(2**(8*data.dtype.itemsize), dtype=unsigned).view(data.dtype)
+		lookupTables[key] = get_LUT_value(values, window, level, rescaleIntercept, rescaleSlope)
+	return numpy.take(lookupTables[key], numpy.ascontiguousarray(data).view(unsigned))
+
+#Rescaling messages already printed by loadDICOM, each one is printed for the first slice that uses it
+reportedRescaling = set()
+
 #This function loads a DCM file and returns a compatible Image object
 # Implemented from: http://stackoverflow.com/questions/119684/parse-dicom-files-in-native-python
 def loadDICOM(filename):
@@ -52,20 +71,23 @@ def loadDICOM(filename):
 
 	rescaleIntercept = dicomFile[0x0028,0x1052].value
 	rescaleSlope = dicomFile[0x0028,0x1053].value
-	print "Rescale intercept/slope",(rescaleIntercept,rescaleSlope),
+	message = "Rescale intercept/slope "+str((rescaleIntercept,rescaleSlope))
 	if dicomFile.RescaleIntercept == None or dicomFile.RescaleSlope == None :
 		rescaleIntercept = 0.0
 		rescaleSlope = 1.0
 
 	# Since we are opening a DICOM file with a possible data value range that exceeds the output format range, we try to use one of the provided window/level values to rescale values
 	if dicomFile.Modality == "CT":
-		print "CT modality, rescaling 1500 500"
-		data = get_LUT_value(data,1500,500,rescaleIntercept,rescaleSlope)
+		message += " CT modality, rescaling 1500 500"
+		data = apply_LUT(data,1500,500,rescaleIntercept,rescaleSlope)
 	elif dicomFile.WindowWidth != None and dicomFile.WindowCenter != None:
-		print "Rescaling",dicomFile.WindowWidth,dicomFile.WindowCenter
-		data = get_LUT_value(data,dicomFile.WindowWidth,dicomFile.WindowCenter,rescaleIntercept,rescaleSlope)
+		message += " Rescaling "+str(dicomFile.WindowWidth)+" "+str(dicomFile.WindowCenter)
+		data = apply_LUT(data,dicomFile.WindowWidth,dicomFile.WindowCenter,rescaleIntercept,rescaleSlope)
 	else:
-		print "No rescaling applied"
+		message += " No rescaling applied"
+	if message not in reportedRescaling:
+		reportedRescaling.add(message)
+		print message
 
 	bits = dicomFile.BitsAllocated
 	samples = dicomFile.SamplesPerPixel
@@ -80,115 +102,69 @@ def loadDICOM(filename):
 
 	return im
 	
+#This function groups the DICOM files by series and orders the slices reading only the headers, before decoding any pixel
+#	(see atlasTools.scanDicomSeries). Returns the files of the series given by options["series"] (by default the one
+#	with more slices) in slice order, or None if the series can not be converted.
+def selectDICOM(filenames, options, jobs=1):
+	try:
+		global dicom
+		global numpy
+		import dicom, numpy
+	except:
+		print "You need dicom package (http://code.google.com/p/pydicom/) and numpy (http://numpy.scipy.org/) to do this!"
+		return None
+	seriesList, unreadable = atlasTools.scanDicomSeries(filenames, jobs)
+	for filename, error in unreadable:
+		print "Warning: skipping",filename,", could not read its DICOM header:",error
+	if not seriesList:
+		print "Could not read the DICOM header of any file"
+		return None
+	if len(seriesList) > 1:
+		print "Found",len(seriesList),"series in the folder:"
+		for series in seriesList:
+			print "	",series.uid,len(series.filenames),"slices"
+	selected = [series for series in seriesList if series.uid == (options["series"] or seriesList[0].uid)]
+	if not selected:
+		print "Series",options["series"],"not found"
+		return None
+	series = selected[0]
+	for error in series.errors:
+		print "Error in series",series.uid,":",error
+	if series.errors:
+		return None
+	print "Converting series",series.uid,":",len(series.filenames),"slices of",series.sliceSize,"spacing",series.spacing
+	return series.filenames
+
+atlasTools.registerLoader("DICOM", loadDICOM, extensions=[".dcm"], options={"series": ""}, selectFunction=selectDICOM,
+	usage=["<InputFolder> must contain only one series of DICOM files to be processed",
+		"--series=UID converts the series with that SeriesInstanceUID, by default the one with more slices"])
+
 #This function uses the images retrieved with loadImgFunction (whould return a PIL.Image) and
-#	writes them as tiles within a new square Image. 
+#	writes them as tiles within a new square Image (see atlasTools.sliceStream and atlasTools.tileSlices).
+#	The filenames are tiled in the given order, the slice order returned by selectDICOM.
 #	Returns a set of Image, size of a slice, number of slices and number of slices per axis
-def ImageSlices2TiledImage(filenames, loadImgFunction=loadDICOM):
-	filenames=sorted(filenames)
-	print "Desired load function=", loadImgFunction.__name__
-	size = loadImgFunction(filenames[0]).size
+def ImageSlices2TiledImage(filenames, loadImgFunction=loadDICOM, jobs=1, cache=None, cacheKey=None):
 	numberOfSlices = len(filenames)
-	slicesPerAxis = int(math.ceil(math.sqrt(numberOfSlices)))
-	imout = Image.new("L", (size[0]*slicesPerAxis, size[1]*slicesPerAxis))
-
-	i = 0
-	for filename in filenames:
-		im = loadImgFunction(filename)
-		
-		row = int( (math.floor(i/slicesPerAxis)) * size[0] )
-		col = int( (i%slicesPerAxis) * size[1] )
-
-		box = ( int(col), int(row), int(col+size[0]), int(row+size[1]) )
-		imout.paste(im, box)
-		i+=1
-		print "processed slice  : "+str(i)+"/"+str(numberOfSlices) #filename
-	return imout, size, numberOfSlices, slicesPerAxis
+	imout = Image.fromarray(atlasTools.tileSlices(atlasTools.sliceStream(filenames, loadImgFunction, jobs=jobs, cache=cache, cacheKey=cacheKey), numberOfSlices))
+	return imout, loadImgFunction(filenames[0]).size, numberOfSlices, atlasTools.slicesPerAxis(numberOfSlices)
 
 #This functions takes a (tiled) image and writes it to a png file with base filename outputFilename.
-#	It also writes several versions in different sizes determined by dimensions
-def WriteVersions(tileImage,outputFilename,dimensions=[8192,4096,2048,1024]):
-	try:
-		print 'Creating folder',os.path.dirname(outputFilename),'...',
-		os.makedirs(os.path.dirname(outputFilename))
-	except OSError as exc:
-		if exc.errno == errno.EEXIST and os.path.isdir(os.path.dirname(outputFilename)):
-			print 'was already there.'
-		else:
-			print ', folders might not be created, trying to write anyways...'
-	except:
-		print "Could not create folders, trying to write anyways..."
-
-	print "Writing complete image: "+outputFilename+"_full.png"
-	try:
-		tileImage.save(outputFilename+"_full.png", "PNG")
-	except:
-		print "Failed writing ",outputFilename+"_full.png"
-	for dim in dimensions:
-		if tileImage.size[0] > dim :
-			print "Writing "+str(dim)+"x"+str(dim)+" version: "+outputFilename+"_"+str(dim)+".png"
-			tmpImage = tileImage.resize((dim,dim))
-			try:
-				tmpImage.save(outputFilename+"_"+str(dim)+".png", "PNG")
-			except:
-				print "Failed writing ",outputFilename,"_",str(dim),".png"
-
-#This function lists the files within a given directory dir
-def listdir_fullpath(d):
-    return [os.path.join(d, f) for f in os.listdir(d)]
-
-#This is the main program, it takes at least 2 arguments <InputFolder> and <OutputFilename>
+#	It also writes several versions in different sizes determined by dimensions (see atlasTools.writeAtlasVersions).
+#	With slicesPerAxis (returned by ImageSlices2TiledImage) the tiles are reduced one by one, without it
+#	the whole image is reduced as before, blending the borders of neighbouring slices.
+def WriteVersions(tileImage,outputFilename,dimensions=[8192,4096,2048,1024],slicesPerAxis=None,jobs=1):
+	if slicesPerAxis is None:
+		print "Warning: slicesPerAxis not given, the versions are reduced as a whole image and the borders of the slices are blended"
+		slicesPerAxis = 1
+	atlasTools.makeOutputFolder(outputFilename)
+	for failed in atlasTools.writeAtlasVersions(tileImage, outputFilename, dimensions, slicesPerAxis, jobs):
+		print "Failed writing ",failed
+
+#This is the main program, it takes at least 2 arguments <InputFolder> and <OutputFilename> (see atlasTools.converterMain)
 def main(argv=None):
-	print "Parsing arguments..."
 	if argv is None:
 		argv = sys.argv
-
-	if len(argv) < 3:
-		print "Usage: command <InputFolder> <OutputFilename>"
-		print "	<InputFolder> must contain only one series of DICOM files to be processed"
-		print "	<OutputFilename> must contain the path and base name of the desired output, extensions will be added automatically"
-		print "Note: this version does not process several DICOM folders recursively. "
-		print "You typed:", argv
-		return 2
-
-	#Filter only DCM files in the given folder
-	filenamesDCM = filter(lambda x: ".DCM" in x or ".dcm" in x, listdir_fullpath(argv[1]))
-
-	#Convert into a tiled image
-	if len(filenamesDCM) > 0:
-		try:
-			global dicom
-			global numpy
-			import dicom, numpy
-		except:
-			print "You need dicom package (http://code.google.com/p/pydicom/) and numpy (http://numpy.scipy.org/) to do this!"
-			return 2
-		#From dcm files
-		imgTile, sliceResolution, numberOfSlices, slicesPerAxis = ImageSlices2TiledImage(filenames,loadDICOM)
-	else:
-		print "No DICOM files found in that folder, check your parameters or contact the authors :)."
-		return 2
-	
-	#Write a text file containing the number of slices for reference
-	try:
-		try:
-			print 'Creating folder',os.path.dirname(argv[2]),'...',
-			os.makedirs(os.path.dirname(argv[2]))
-		except OSError as exc:
-			if exc.errno == errno.EEXIST and os.path.isdir(os.path.dirname(argv[2])):
-				print 'was already there.'
-			else:
-				print ', folders might not be created, trying to write anyways...'
-		except:
-			print ", could not create folders, trying to write anyways..."
-		with open(argv[2]+"_AtlasDim.txt",'w') as f:
-			f.write(str((numberOfSlices,(slicesPerAxis,slicesPerAxis))))
-	except:
-		print "Could not write a text file",argv[2]+"_AtlasDim.txt","containing dimensions (total slices, slices per axis):",(numberOfSlices,(slicesPerAxis,slicesPerAxis))
-	else:
-		print "Created",argv[2]+"_AtlasDim.txt","containing dimensions (total slices, slices per axis):",(numberOfSlices,(slicesPerAxis,slicesPerAxis))
-
-	#Output is written in different sizes
-	WriteVersions(imgTile, argv[2])
+	return atlasTools.converterMain(argv, "DICOM", ["Note: this version does not process several DICOM folders recursively, use batchConvert.py for that."])
 
 if __name__ == "__main__":
 	sys.exit(main())
@@ -11,6 +11,7 @@ data slices into a tiled 2D texture image in PNG format (it assumes all files
 in the folder are of the same type and dimensions).
 It requires Python with PIL, numpy, matplolib and ndimage packages. 
 pydicom and pynrrd packages are needed for dicom and nrrd file type formats.
+atlasTools.py must be in the same folder.
 
 Information links:
 http://www.volumerc.org
@@ -20,12 +21,18 @@ Contact mailto:volumerendering@vicomtech.org
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import ndimage, misc
-#from PIL import Image
+from PIL import Image
 import nrrd
 import dicom
 import math
 import argparse
+import collections
+import time
 import os, errno
+import sys
+import gzip
+import json
+import atlasTools
 
 #######################
 #  Exception Handlers #
@@ -38,6 +45,17 @@ class VolumeFileReaderException(Exception):
     """Incorrect file input used, or not posible to load."""
     pass
 
+# Numpy type of each nrrd type name, used when memory mapping nrrd files
+NRRD_TYPES = {'signed char':'i1', 'int8':'i1', 'int8_t':'i1',
+    'uchar':'u1', 'unsigned char':'u1', 'uint8':'u1', 'uint8_t':'u1',
+    'short':'i2', 'short int':'i2', 'signed short':'i2', 'signed short int':'i2', 'int16':'i2', 'int16_t':'i2',
+    'ushort':'u2', 'unsigned short':'u2', 'unsigned short int':'u2', 'uint16':'u2', 'uint16_t':'u2',
+    'int':'i4', 'signed int':'i4', 'int32':'i4', 'int32_t':'i4',
+    'uint':'u4', 'unsigned int':'u4', 'uint32':'u4', 'uint32_t':'u4',
+    'longlong':'i8', 'long long':'i8', 'long long int':'i8', 'signed long long':'i8', 'signed long long int':'i8', 'int64':'i8', 'int64_t':'i8',
+    'ulonglong':'u8', 'unsigned long long':'u8', 'unsigned long long int':'u8', 'uint64':'u8', 'uint64_t':'u8',
+    'float':'f4', 'double':'f8'}
+
 class GradientCalculationException(Exception):
     """Error while generating the gradient, whith the ndimage library."""
     pass
@@ -57,6 +75,7 @@ class GradientCalculation:
     
     @staticmethod
     def normalize(inputData):
+        """Image normalization between 0 and 1"""
         old_min = inputData.min()
         old_range = inputData.max()-old_min
         return (inputData-old_min)/old_range
@@ -69,65 +88,134 @@ class GradientCalculation:
         newRange = newMax-newMin
         return (inputData-oldMin)*(newRange/oldRange)+newMin
         
+    @staticmethod
+    def _normalizeInPlace(gradient, minimum, maximum, normalization):
+        """Normalizes the channels of a gradient array in place, with the same operations as normalize
+        ('global') or normalize_range(channel, 0, 1) ('channel'), given the minimum and maximum of each channel.
+        A fourth (magnitude) channel is divided by its maximum, so 0 keeps meaning a flat region."""
+        rgb = gradient[...,:3]
+        if normalization == 'global':
+            rgb -= minimum[:3].min()
+            rgb /= maximum[:3].max()-minimum[:3].min()
+        else:
+            for i in range(3):
+                rgb[...,i] -= minimum[i]
+                rgb[...,i] *= 1/(maximum[i]-minimum[i])
+        if gradient.shape[-1] == 4 and maximum[3] > 0:
+            gradient[...,3] /= maximum[3]
+    
+    @staticmethod
+    def _storeMagnitude(gradient):
+        """Writes the magnitude of the (not normalized) gradient channels of a (X, Y, Z, 4) array in its fourth channel"""
+        for z in range(gradient.shape[2]):
+            gradientSlice = gradient[:,:,z]
+            np.sqrt(np.sum(gradientSlice[...,:3]**2, axis=-1), out=gradientSlice[...,3])
+    
+    @staticmethod
+    def gradientRGB(inputData, method='gauss', precision=np.float64, sigmaValue=1, magnitude=False):
+        """Computes the normalized gradient of a method. Each channel is written directly into
+        a single (X, Y, Z, 3) array of the given precision, which is then normalized in place.
+        With magnitude, a (X, Y, Z, 4) array is returned with the gradient magnitude, calculated
+        from the same derivatives, in the fourth channel."""
+        filters, support, normalization = GradientCalculation._channelFilters(method, sigmaValue)
+        gradient = np.empty(inputData.shape + (4 if magnitude else 3,), dtype=precision)
+        for i, channelFilter in enumerate(filters):
+            channelFilter(inputData, gradient[...,i])
+        if magnitude:
+            GradientCalculation._storeMagnitude(gradient)
+        minimum = np.array([gradient[...,i].min() for i in range(gradient.shape[-1])])
+        maximum = np.array([gradient[...,i].max() for i in range(gradient.shape[-1])])
+        GradientCalculation._normalizeInPlace(gradient, minimum, maximum, normalization)
+        return gradient
+    
     @staticmethod    
-    def gaussFilterRGB(inputData, sigmaValue=1):
-        #Initialize an array with the same shape as the input data for each color channel
-        r = np.zeros(inputData.shape)
-        g = np.zeros(inputData.shape)
-        b = np.zeros(inputData.shape)
-        #Calculate the gaussian filter on each axis
-        ndimage.gaussian_filter1d(inputData, sigma=sigmaValue, axis=1, order=1, output=r)
-        ndimage.gaussian_filter1d(inputData, sigma=sigmaValue, axis=0, order=1, output=g)
-        ndimage.gaussian_filter1d(inputData, sigma=sigmaValue, axis=2, order=1, output=b)
-        #Compose each chanel on an array structure 
-        return GradientCalculation.normalize(np.concatenate((r[...,np.newaxis],g[...,np.newaxis],b[...,np.newaxis]),axis=3))
+    def gaussFilterRGB(inputData, sigmaValue=1, precision=np.float64):
+        return GradientCalculation.gradientRGB(inputData, 'gauss', precision, sigmaValue)
     
     @staticmethod
-    def prewittFilterRGB(inputData):
-        r = np.zeros(inputData.shape)
-        g = np.zeros(inputData.shape)
-        b = np.zeros(inputData.shape)
-        ndimage.prewitt(inputData, axis=1, output=r)
-        ndimage.prewitt(inputData, axis=0, output=g)
-        ndimage.prewitt(inputData, axis=2, output=b)
-        return GradientCalculation.normalize(np.concatenate((r[...,np.newaxis],g[...,np.newaxis],b[...,np.newaxis]),axis=3))
+    def prewittFilterRGB(inputData, precision=np.float64):
+        return GradientCalculation.gradientRGB(inputData, 'prewitt', precision)
     
     @staticmethod    
-    def sobelFilterRGB(inputData):
-        r = np.zeros(inputData.shape)
-        g = np.zeros(inputData.shape)
-        b = np.zeros(inputData.shape)
-        ndimage.sobel(inputData, axis=1, output=r)
-        ndimage.sobel(inputData, axis=0, output=g)
-        ndimage.sobel(inputData, axis=2, output=b)
-        return GradientCalculation.normalize(np.concatenate((r[...,np.newaxis],g[...,np.newaxis],b[...,np.newaxis]),axis=3))
+    def sobelFilterRGB(inputData, precision=np.float64):
+        return GradientCalculation.gradientRGB(inputData, 'sobel', precision)
         
     @staticmethod    
-    def centralDifferencesRGB(inputData):
-        r = np.zeros(inputData.shape)
-        g = np.zeros(inputData.shape)
-        b = np.zeros(inputData.shape)
-        ndimage.correlate1d(inputData, [-1, 0, 1], axis=1, output=r)
-        ndimage.correlate1d(inputData, [-1, 0, 1], axis=0, output=g)
-        ndimage.correlate1d(inputData, [-1, 0, 1], axis=2, output=b)
-        r = GradientCalculation.normalize_range(r, 0, 1)
-        g = GradientCalculation.normalize_range(g, 0, 1)
-        b = GradientCalculation.normalize_range(b, 0, 1) 
-        return np.concatenate((r[...,np.newaxis],g[...,np.newaxis],b[...,np.newaxis]),axis=3)
+    def centralDifferencesRGB(inputData, precision=np.float64):
+        return GradientCalculation.gradientRGB(inputData, 'central-differences', precision)
         
     @staticmethod
-    def forwardDifferencesRGB(inputData):
-        r = np.zeros(inputData.shape)
-        g = np.zeros(inputData.shape)
-        b = np.zeros(inputData.shape)
-        ndimage.correlate1d(inputData, [-1, 1], origin=-1, axis=1, output=r)
-        ndimage.correlate1d(inputData, [-1, 1], origin=-1, axis=0, output=g)
-        ndimage.correlate1d(inputData, [-1, 1], origin=-1, axis=2, output=b)
-        return GradientCalculation.normalize(np.concatenate((r[...,np.newaxis],g[...,np.newaxis],b[...,np.newaxis]),axis=3))
+    def forwardDifferencesRGB(inputData, precision=np.float64):
+        return GradientCalculation.gradientRGB(inputData, 'forward-differences', precision)
     
     @staticmethod
-    def gaussMagnitudeRGB(inputData):
-        pass
+    def gaussMagnitudeRGB(inputData, sigmaValue=1, precision=np.float64):
+        return GradientCalculation.gradientRGB(inputData, 'gauss', precision, sigmaValue, magnitude=True)
+    
+    @staticmethod
+    def _channelFilters(method, sigmaValue=1):
+        """Returns the filters computing each gradient channel (r, g, b) of a method as functions
+        (inputData, output), the number of neighbour voxels they use on each side, and the
+        normalization of the method: 'global' (normalize) or 'channel' (normalize_range)"""
+        if method == 'gauss':
+            gauss = lambda axis: lambda inputData, output: ndimage.gaussian_filter1d(inputData, sigma=sigmaValue, axis=axis, order=1, output=output)
+            #gaussian_filter1d truncates the kernel at 4 standard deviations
+            return [gauss(1), gauss(0), gauss(2)], int(4.0*sigmaValue+0.5), 'global'
+        elif method == 'prewitt':
+            prewitt = lambda axis: lambda inputData, output: ndimage.prewitt(inputData, axis=axis, output=output)
+            return [prewitt(1), prewitt(0), prewitt(2)], 1, 'global'
+        elif method == 'sobel':
+            sobel = lambda axis: lambda inputData, output: ndimage.sobel(inputData, axis=axis, output=output)
+            return [sobel(1), sobel(0), sobel(2)], 1, 'global'
+        elif method == 'central-differences':
+            central = lambda axis: lambda inputData, output: ndimage.correlate1d(inputData, [-1, 0, 1], axis=axis, output=output)
+            return [central(1), central(0), central(2)], 1, 'channel'
+        elif method == 'forward-differences':
+            forward = lambda axis: lambda inputData, output: ndimage.correlate1d(inputData, [-1, 1], origin=-1, axis=axis, output=output)
+            return [forward(1), forward(0), forward(2)], 1, 'global'
+        raise GradientCalculationException('Method %s is not suported.' % method)
+    
+    @staticmethod
+    def _slabGradient(state, slab):
+        """Computes the gradient channels of the slices slab[0] to slab[1] into the output array, reading
+        the neighbour slices needed by the filters (halo), and the magnitude if the output has four channels.
+        Returns the minimum and maximum of each channel."""
+        inputData, output, filters, support = state
+        first, last = slab
+        haloFirst, haloLast = max(0, first-support), min(inputData.shape[2], last+support)
+        block = inputData[:,:,haloFirst:haloLast]
+        channel = np.empty(block.shape, dtype=output.dtype)
+        for i, channelFilter in enumerate(filters):
+            channelFilter(block, channel)
+            output[:,:,first:last,i] = channel[:,:,first-haloFirst:last-haloFirst]
+        if output.shape[-1] == 4:
+            GradientCalculation._storeMagnitude(output[:,:,first:last])
+        stats = np.empty((2, output.shape[-1]))
+        for i in range(output.shape[-1]):
+            stats[0,i] = output[:,:,first:last,i].min()
+            stats[1,i] = output[:,:,first:last,i].max()
+        return stats
+    
+    @staticmethod
+    def blockedGradientRGB(inputData, method='gauss', slabSize=32, jobs=1, precision=np.float64, sigmaValue=1, magnitude=False):
+        """Computes the same gradient as gradientRGB, processing the volume in z slabs of
+        slabSize slices with a halo as wide as the filter support. With jobs > 1 the slabs are
+        computed by a pool of processes writing into a shared output. The minimum and maximum
+        of every slab are gathered first, so all of them are normalized with the global values."""
+        filters, support, normalization = GradientCalculation._channelFilters(method, sigmaValue)
+        shape = inputData.shape + (4 if magnitude else 3,)
+        output = atlasTools.sharedVolume(shape, precision) if jobs > 1 else np.empty(shape, dtype=precision)
+        slabs = [(z, min(z+slabSize, inputData.shape[2])) for z in range(0, inputData.shape[2], slabSize)]
+        state = (inputData, output, filters, support)
+        if jobs > 1 and hasattr(os, 'fork'):
+            stats = list(atlasTools.forkedImap(GradientCalculation._slabGradient, slabs, jobs, state))
+        else:
+            stats = [GradientCalculation._slabGradient(state, slab) for slab in slabs]
+        minimum = np.min([s[0] for s in stats], axis=0)
+        maximum = np.max([s[1] for s in stats], axis=0)
+        for first, last in slabs:
+            GradientCalculation._normalizeInPlace(output[:,:,first:last], minimum, maximum, normalization)
+        return output
     
 
 #########################
@@ -141,6 +229,15 @@ class VolumeData:
         self.data = ndarray # numpy array containing the volume data
         self.type = a_type # Volume data array_type
         self.gradient = None # Not calculated yet
+        self.gradientMagnitude = None # Not calculated yet
+        self.gradientRGBA = None # Gradient (rgb) and magnitude (a) packed in one array
+        self.brickSize = None # Voxels per side of the bricks of the brick grid, not calculated yet
+        self.brickMin = None # Minimum value of each brick
+        self.brickMax = None # Maximum value of each brick
+        self.distanceField = None # Chebyshev distance of each brick to the nearest non-empty one, not calculated yet
+        self.distanceThreshold = None # Bricks with values above it are non-empty
+        self.cropOffset = None # Offset (x, y, z) of the data in the original volume, if cropped
+        self.uncroppedShape = None # Shape of the original volume, if cropped
         self.header=header_info # Usually for nrrd files
         self._checkPaddingAndSize()
     
@@ -150,50 +247,88 @@ class VolumeData:
     
     def getAtlas(self):
         """Returns a numpy array, containing the 2D image of the volume data atlas"""
-        volumeSize = (self.data.shape[0], self.data.shape[1])
-        numberOfSlices = self.data.shape[2]
-        slicesPerAxis = int(math.ceil(math.sqrt(numberOfSlices)))
-        atlasArray = np.zeros((volumeSize[0]*slicesPerAxis, volumeSize[1]*slicesPerAxis))
-        
-        for i in range(0, numberOfSlices):
-            row = int((math.floor(i/slicesPerAxis)) * volumeSize[0])
-            col = int((i%slicesPerAxis) * volumeSize[1])
-            box = (row, col, int(row+volumeSize[0]), int(col+volumeSize[1]))
-            atlasArray[box[0]:box[2],box[1]:box[3]] = self.data[:,:,i]
-        
-        return atlasArray
+        return atlasTools.volumeToAtlas(self.data)
         
     def getGradientAtlas(self):
         """Returns a numpy array, containing the 2D image of the gradient atlas"""
-        if self.gradient != None:
-            volumeSize = (self.gradient.shape[0], self.gradient.shape[1])
-            numberOfSlices = self.gradient.shape[2]
-            slicesPerAxis = int(math.ceil(math.sqrt(numberOfSlices)))
-            atlasArray = np.zeros((volumeSize[0]*slicesPerAxis, volumeSize[1]*slicesPerAxis,3))
-            
-            for i in range(0, numberOfSlices):
-                row = int((math.floor(i/slicesPerAxis)) * volumeSize[0])
-                col = int((i%slicesPerAxis) * volumeSize[1])
-                box = (row, col, int(row+volumeSize[0]), int(col+volumeSize[1]))
-                atlasArray[box[0]:box[2],box[1]:box[3],:] = self.gradient[:,:,i,:]
-            
-            return atlasArray
+        if self.gradient is not None:
+            return atlasTools.volumeToAtlas(self.gradient if self.gradientRGBA is None else self.gradientRGBA)
         else:
             print 'The gradient must be prviously computed!'
             
-    def calculateGradientRGB(self, method='gauss'):
-        """Calculates the gradient data from the volume data"""
-        try:
-            self.gradient = ({'gauss':GradientCalculation.gaussFilterRGB, 'sobel':GradientCalculation.sobelFilterRGB, \
-            'prewitt':GradientCalculation.prewittFilterRGB, 'central-differences':GradientCalculation.centralDifferencesRGB}[method])(self.data)
-        except KeyError:
-            raise GradientCalculationException('Method %s is not suported.' % method)
-        pass
+    def calculateGradientRGB(self, method='gauss', slabSize=None, jobs=1, precision=np.float64, magnitude=False):
+        """Calculates the gradient data from the volume data, with the given floating point precision.
+        If slabSize is given, or jobs > 1, the volume is processed in z slabs of slabSize slices
+        (see GradientCalculation.blockedGradientRGB)"""
+        with atlasTools.stage('gradient '+method, self.data.nbytes) as record:
+            if slabSize or jobs > 1:
+                gradient = GradientCalculation.blockedGradientRGB(self.data, method, slabSize or int(math.ceil(self.data.shape[2]/float(jobs))), jobs, precision, magnitude=magnitude)
+            else:
+                gradient = GradientCalculation.gradientRGB(self.data, method, precision, magnitude=magnitude)
+            record['bytesOut'] = gradient.nbytes
+        self.setGradient(gradient)
     
-    def calculateGradientMagnitudeRGB(self, method='gauss'):
-        """Calculates the gradient magnitude data from the volume data"""
-        #TODO, calculate the gradient magnitude
-        pass
+    def setGradient(self, gradient):
+        """Sets a calculated (X, Y, Z, 3) gradient, or (X, Y, Z, 4) gradient and magnitude, such as
+        one reopened from an atlasTools.ConversionCache"""
+        self.gradient = gradient[...,:3]
+        if gradient.shape[3] > 3:
+            self.gradientRGBA = gradient
+            self.gradientMagnitude = gradient[...,3]
+        else:
+            self.gradientRGBA = None
+            self.gradientMagnitude = None
+    
+    def cropToBoundingBox(self, threshold=0):
+        """Crops the volume data to the bounding box of its voxels above threshold (see atlasTools.boundingBox),
+        reading a memory mapped volume one slab at a time. Returns the box, or None if no voxel is above
+        threshold and the volume is not cropped. Call it before calculating the gradient."""
+        with atlasTools.stage('bounding box', self.data.nbytes):
+            box = atlasTools.boundingBox(atlasTools.volumeSlabs(self.data), threshold)
+        if box is not None:
+            (x0, x1), (y0, y1), (z0, z1) = box
+            self.uncroppedShape = self.data.shape[:3]
+            self.cropOffset = (x0, y0, z0)
+            self.data = self.data[x0:x1, y0:y1, z0:z1]
+            #The bricks of the original volume are not aligned with the cropped one
+            self.brickSize, self.brickMin, self.brickMax = None, None, None
+        return box
+    
+    def calculateBricks(self, brickSize=16):
+        """Calculates the minimum and maximum values of each brickSize^3 brick of the volume data (see
+        atlasTools.brickMinMax), a coarse grid to skip the empty space when rendering the atlas. Nothing
+        is done if the grid was already reduced while reading the slices (see VolumeFileReader.loadFile)."""
+        if self.brickSize == brickSize and self.brickMax is not None:
+            return
+        with atlasTools.stage('brick grid', self.data.nbytes) as record:
+            self.brickMin, self.brickMax = atlasTools.brickMinMax(self.data, brickSize)
+            record['bytesOut'] = self.brickMin.nbytes + self.brickMax.nbytes
+        self.brickSize = brickSize
+    
+    def calculateDistanceField(self, threshold=None, brickSize=8):
+        """Calculates the Chebyshev (chessboard) distance, in bricks, from each brick of the brick grid to the
+        nearest brick with values above threshold (by default the minimum value of the volume), 0 for those
+        bricks and 255 at most. The brick grid is calculated first if needed (see calculateBricks). From a
+        brick at distance d a ray can advance (d-1)*brickSize voxels along any direction without missing
+        a non-empty voxel."""
+        if self.brickMax is None:
+            self.calculateBricks(brickSize)
+        with atlasTools.stage('distance field', self.brickMax.nbytes) as record:
+            if threshold is None:
+                threshold = self.brickMin.min()
+            empty = self.brickMax <= threshold
+            if empty.all():
+                distance = np.full(empty.shape, 255)
+            else:
+                distance = ndimage.distance_transform_cdt(empty, metric='chessboard')
+            self.distanceField = np.minimum(distance, 255).astype(np.uint8)
+            record['bytesOut'] = self.distanceField.nbytes
+        self.distanceThreshold = threshold
+    
+    def calculateGradientMagnitudeRGB(self, method='gauss', slabSize=None, jobs=1, precision=np.float64):
+        """Calculates the gradient and its magnitude data from the volume data in one pass.
+        The magnitude is normalized to [0, 1] and stored with the gradient in gradientRGBA"""
+        self.calculateGradientRGB(method, slabSize, jobs, precision, magnitude=True)
     
     def showSlice(self, num):
         """Display a given slice"""
@@ -224,67 +359,123 @@ class VolumeData:
 ############################
 class VolumeFileReader:
     """Volume File Reader class. Creates a VolumeData object instance from a volume file
-    name and path. Supported file types, nrrd, dicom, raw, jpg, png"""
+    name and path. Supported file types, nrrd, dicom, raw, jpg, png and the slice
+    formats registered with atlasTools.registerLoader"""
     data = None
-    def __init__(self, filePath):
+    header = None
+    def __init__(self, filePath, loader=None, loaderOptions=None):
+        """The files are read with their built-in reader, or with the registered slice format of their
+        extension. With a loader (an atlasTools.SliceLoader) all the files it accepts are read with it,
+        built with the given format options (see atlasTools.SliceLoader.parseOptions)."""
         self.path = filePath
         self.fileList = []
         self.loaded = False
+        self.series = None # atlasTools.DicomSeries of the dicom files, see selectDicomSeries
+        self.seriesUID = None # SeriesInstanceUID of the dicom series loaded by loadFile, by default the one with more files
+        self.loader = loader # atlasTools.SliceLoader of the files of other registered slice formats
+        self.loaderOptions = dict(loaderOptions or {}) # Options of the loader
+        self._loadFunction = None # Load function of the loader, built for its options
+        self.brickSize = None # Voxels per side of the bricks of the brick grid reduced while reading the slices
+        self.brickMin = None # Minimum value of each brick, if reduced while reading
+        self.brickMax = None # Maximum value of each brick, if reduced while reading
         #Detect if there is more than one file
         if(os.path.isfile(filePath)):
-            self._obtainExtensionAndName(filePath)
+            if self.loader is not None:
+                self.fileList = [filePath]
+            else:
+                self._obtainExtensionAndName(filePath)
         else:
             if(os.path.isdir(filePath)):
                 filenames = os.listdir(filePath)
+                if self.loader is not None:
+                    #Selected slice format, every file of the folder it accepts
+                    self.fileList = [os.path.join(filePath, f) for f in filenames if self.loader.accepts(f) and os.path.isfile(os.path.join(filePath, f))]
+                    filenames = []
                 for f in filenames:
                     if f.endswith(('.jpg', 'jpeg', '.giff', '.tiff', '.png', '.dcm')):
                         self.fileList.append(os.path.join(filePath, f))
+                if not self.fileList:
+                    #Slice formats registered with atlasTools.registerLoader for their extension (see the --plugin option)
+                    loaders = filter(None, map(atlasTools.findLoader, sorted(filenames)))
+                    if loaders:
+                        self.loader = loaders[0]
+                        self.fileList = [os.path.join(filePath, f) for f in filenames if self.loader.accepts(f)]
                 self.fileList.sort() #Alphabetically sort the list, because it could be read randomly
             else:
                 raise VolumeFileReaderException("Incorrect use of input file. Can not open file/files!")
     
+    def selectDicomSeries(self, seriesUID=None, jobs=1):
+        """Reads only the headers of the dicom files (in jobs processes), and keeps the files of the
+        series seriesUID (by default the one with more files) in slice order. The files whose header can not
+        be read (a DICOMDIR, a truncated file...) are skipped with a warning. Raises a VolumeFileReaderException
+        if no header can be read or the series has missing or duplicated slices."""
+        seriesList, unreadable = atlasTools.scanDicomSeries(self.fileList, jobs)
+        for filename, error in unreadable:
+            print 'Warning!! Skipping %s, can not read its dicom header: %s' % (filename, error)
+        if not seriesList:
+            raise VolumeFileReaderException('Can not read the dicom header of any file!')
+        if len(seriesList) > 1:
+            print 'Found %d series: %s' % (len(seriesList), ', '.join('%s (%d slices)' % (s.uid, len(s.filenames)) for s in seriesList))
+        selected = [s for s in seriesList if seriesUID in (None, s.uid)]
+        if not selected:
+            raise VolumeFileReaderException('Series %s not found!' % seriesUID)
+        self.series = selected[0]
+        if self.series.errors:
+            raise VolumeFileReaderException('Series %s: %s' % (self.series.uid, '; '.join(self.series.errors)))
+        print 'Series %s: %d slices of %s, spacing %s' % (self.series.uid, len(self.series.filenames), str(self.series.sliceSize), str(self.series.spacing))
+        self.fileList = self.series.filenames
+    
     def _obtainExtensionAndName(self, filePath):
         """Extracts the file name and file extension fron a given full file path"""
         self.fileName, self.fileExtension = os.path.splitext(filePath)
         
-    def _readNrrd(self):
+    def _memoryMapNrrd(self):
+        """Opens a raw encoded nrrd file as a read-only memory map, returns False if it is not possible"""
+        with open(self.path, 'rb') as f:
+            header_info = nrrd.read_header(f)
+            offset = f.tell()
+        byteskip = header_info.get('byteskip', header_info.get('byte skip', 0))
+        if header_info.get('encoding') != 'raw' or header_info.get('type') not in NRRD_TYPES or \
+                header_info.get('lineskip', header_info.get('line skip', 0)) != 0 or \
+                'datafile' in header_info or 'data file' in header_info:
+            print 'The nrrd file can not be memory mapped (only raw encoding with attached data), reading it...'
+            return False
+        dtype = np.dtype(NRRD_TYPES[header_info['type']])
+        if dtype.itemsize > 1:
+            dtype = dtype.newbyteorder('>' if header_info.get('endian') == 'big' else '<')
+        shape = tuple(header_info['sizes'])
+        if byteskip == -1:
+            offset = os.path.getsize(self.path) - dtype.itemsize*int(np.prod(shape))
+        else:
+            offset += byteskip
+        #nrrd data layout is the one numpy calls 'Fortran' order
+        self.data = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F')
+        self.header = header_info
+        print header_info
+        return True
+        
+    def _readNrrd(self, memoryMap=False):
         """Loads a nrrd file, it uses the pynrrd package"""
         try:
+            if memoryMap and self._memoryMapNrrd():
+                return
             self.data, header_info = nrrd.read(self.path)
+            self.header = header_info
             print header_info
         except:
             print 'Error reading the nrrd file!'
             print 'You need pynrrd package. sudo easy_install pynrrd'
             exit()
     
-    def _readDicom(self, fileName):
-        """Loads a dicom file using the pydicom package"""
-        try:
-            dicomFile = dicom.read_file(fileName, force=True)
-        except:
-            print 'Error reading the dicom file!'
-            print 'You need dicom package, sudo easy_install pydicom'
-        
-        arr = dicomFile.pixel_array.astype(np.float64)
-        
-        if ('RescaleIntercept' in dicomFile) and ('RescaleSlope' in dicomFile):
-            intercept = dicomFile.RescaleIntercept  # single value
-            slope = dicomFile.RescaleSlope
+    @staticmethod
+    def _windowLevel(pixels, rescale, wc, ww):
+        """Maps pixel values to uint8, rescaling them with the (slope, intercept) pair rescale if given,
+        and applying the window center wc and width ww as in pydicom's LUT"""
+        arr = pixels.astype(np.float64)
+        if rescale is not None:
+            slope, intercept = rescale
             arr = slope * arr + intercept
         
-        # get default window_center and window_width values
-        wc = (arr.max() + arr.min()) / 2.0
-        ww = arr.max() - arr.min() + 1.0
-        #get window_center and window_width is setted
-        if ('WindowCenter' in dicomFile) and ('WindowWidth' in dicomFile):
-            wc = dicomFile.WindowCenter
-            # width >= 1 (DICOM standard)
-            ww = max(1, dicomFile.WindowWidth)
-            if isinstance(wc, list):
-                wc = wc[0]
-            if isinstance(ww, list):
-                ww = ww[0]
-                
         # LUT-specific array scaling
         wc, ww = np.float64(wc), np.float64(ww)
         lut_max, lut_min = np.float64(255), np.float64(0)
@@ -307,60 +498,197 @@ class VolumeFileReader:
         # round to next integer values and convert to unsigned int
         return np.rint(arr).astype(np.uint8)
     
+    # Lookup tables of _readDicom by data type, rescale and window, the oldest are removed after MAX_LOOKUP_TABLES
+    _lookupTables = collections.OrderedDict()
+    MAX_LOOKUP_TABLES = 8
+    
+    def _readDicom(self, fileName):
+        """Loads a dicom file using the pydicom package. When the file has window tags, 8 and 16 bit integer
+        pixels are mapped with a lookup table of every possible value, shared by the slices with the same
+        parameters. The window of the files without window tags depends on each slice, they are mapped directly."""
+        try:
+            dicomFile = dicom.read_file(fileName, force=True)
+        except:
+            print 'Error reading the dicom file!'
+            print 'You need dicom package, sudo easy_install pydicom'
+        
+        pixels = dicomFile.pixel_array
+        rescale = None
+        if ('RescaleIntercept' in dicomFile) and ('RescaleSlope' in dicomFile):
+            rescale = (dicomFile.RescaleSlope, dicomFile.RescaleIntercept)
+        
+        #get window_center and window_width is setted
+        windowTags = ('WindowCenter' in dicomFile) and ('WindowWidth' in dicomFile)
+        if windowTags:
+            wc = dicomFile.WindowCenter
+            # width >= 1 (DICOM standard)
+            ww = max(1, dicomFile.WindowWidth)
+            if isinstance(wc, list):
+                wc = wc[0]
+            if isinstance(ww, list):
+                ww = ww[0]
+        else:
+            # default window_center and window_width values, from the range of the rescaled values
+            extremes = np.array([pixels.min(), pixels.max()], dtype=np.float64)
+            if rescale is not None:
+                extremes = rescale[0] * extremes + rescale[1]
+            wc = (extremes.max() + extremes.min()) / 2.0
+            ww = extremes.max() - extremes.min() + 1.0
+        
+        if not windowTags or pixels.dtype.kind not in 'iu' or pixels.dtype.itemsize > 2:
+            return self._windowLevel(pixels, rescale, wc, ww)
+        #The table is indexed by the unsigned integer with the same bits as each pixel
+        unsigned = np.dtype('u%d' % pixels.dtype.itemsize)
+        key = (pixels.dtype.str, repr(rescale), repr(wc), repr(ww))
+        if key not in self._lookupTables:
+            if len(self._lookupTables) >= self.MAX_LOOKUP_TABLES:
+                self._lookupTables.popitem(last=False)
+            values = np.arange(2**(8*pixels.dtype.itemsize), dtype=unsigned).view(pixels.dtype)
+            self._lookupTables[key] = self._windowLevel(values, rescale, wc, ww)
+        return np.take(self._lookupTables[key], np.ascontiguousarray(pixels).view(unsigned))
+    
+    def _readImage(self, fileName):
+        """Loads a standard image file using PIL. 8 and 16 bit grey images keep their integer values,
+        other images are converted to grey float32 values"""
+        image = Image.open(fileName)
+        if image.mode in ('L', 'I;16'):
+            return np.asarray(image)
+        return ndimage.imread(fileName, flatten=True)
+    
+    def _readRegisteredImage(self, fileName):
+        """Loads a slice with the load function of its registered slice format (a PIL.Image).
+        8 and 16 bit grey images keep their integer values, other images are converted to grey float32 values"""
+        if self._loadFunction is None:
+            self._loadFunction = self.loader.loadFunction(self.loaderOptions)
+        image = self._loadFunction(fileName)
+        if image.mode in ('L', 'I;16'):
+            return np.asarray(image)
+        return np.asarray(image.convert('F'))
+    
+    def _readSlices(self, readFunction, jobs=1, brickSize=None):
+        """Reads each file of the list as a slice of a volume preallocated from the first one.
+        With jobs > 1 the files are read by a pool of processes writing into a shared volume.
+        With brickSize, the brick grid (see atlasTools.brickMinMax) is reduced in the same pass,
+        each slab of brickSize slices right after it is read."""
+        if jobs > 1:
+            if brickSize:
+                self.data, self.brickMin, self.brickMax = atlasTools.decodeSlicesParallel(self.fileList, readFunction, jobs, brickSize)
+                self.brickSize = brickSize
+            else:
+                self.data = atlasTools.decodeSlicesParallel(self.fileList, readFunction, jobs)
+            return
+        first = readFunction(self.fileList[0])
+        numberOfSlices = len(self.fileList)
+        self.data = np.empty(first.shape + (numberOfSlices,), dtype=first.dtype)
+        self.data[:,:,0] = first
+        grids = []
+        for i in range(1, numberOfSlices+1):
+            if i < numberOfSlices:
+                self.data[:,:,i] = readFunction(self.fileList[i])
+            if brickSize and (i % brickSize == 0 or i == numberOfSlices):
+                grids.append(atlasTools.brickSlabMinMax(self.data[:,:,len(grids)*brickSize:i], brickSize))
+        if brickSize:
+            self.brickMin, self.brickMax = (np.stack([grid[k] for grid in grids], axis=2) for k in (0, 1))
+            self.brickSize = brickSize
+    
+    def _memoryMapRaw(self, sizeInput=(512,512), slides=512, dataType='uint8'):
+        """Opens a raw file as a read-only memory map with a given volume data dimensions and data type."""
+        sliceBytes = sizeInput[0]*sizeInput[1]*np.dtype(dataType).itemsize
+        available = os.path.getsize(self.path) // sliceBytes
+        if available < slides:
+            print 'Warning!! Only %d complete slices found in the file, continuing anyway!' % available
+            slides = available
+        #Slices are contiguous in the file, the (X, Y, Z) volume is a view of the (Z, X, Y) map
+        volumeMap = np.memmap(self.path, dtype=dataType, mode='r', shape=(slides,)+tuple(sizeInput))
+        self.data = volumeMap.transpose(1, 2, 0)
+        self.loaded = True
+    
     def _readRaw(self, sizeInput=(512,512), slides=512, dataType='uint8'):
         """Loads a raw file with a given volume data dimensions and data type. """
-        f = open(self.path, "rb")
-        try:
-            first_time = True
-            for _ in range((slides-1)):
-                if first_time:
-                    self.data = np.fromfile(f, dataType, sizeInput[0]*sizeInput[1]).reshape(sizeInput)
-                    first_time = False                    
-                raw = np.fromfile(f, dataType, sizeInput[0]*sizeInput[1]).reshape(sizeInput)
-                self.data = np.dstack((self.data, raw))
-            self.loaded = True
-        except EOFError:
-            return self.data
-        except ValueError:
-            print 'Warning!! ValueError when reshaping the data, continuing anyway!'
-            self.loaded = True
-        finally:
-            f.close()
+        sliceSize = sizeInput[0]*sizeInput[1]
+        self.data = np.empty(tuple(sizeInput) + (slides,), dtype=dataType)
+        with open(self.path, "rb") as f:
+            for i in range(slides):
+                raw = np.fromfile(f, dataType, sliceSize)
+                if raw.size < sliceSize:
+                    print 'Warning!! Only %d complete slices found in the file, continuing anyway!' % i
+                    self.data = self.data[:,:,:i]
+                    break
+                self.data[:,:,i] = raw.reshape(sizeInput)
+        self.loaded = True
         
-    def loadFile(self, imageSize=(None,None), numberOfSlices=None, dataType='uint8'):
-        """Loads the file or images containing the volume data into a numpy array"""
+    def cacheKey(self, cache, imageSize=(None,None), numberOfSlices=None, dataType='uint8'):
+        """Returns the key of the volume in an atlasTools.ConversionCache, from its files and loading parameters"""
+        return cache.key(self.fileList or [self.path], loader='VolumeFileReader', imageSize=tuple(imageSize), numberOfSlices=numberOfSlices, dataType=dataType,
+            series=self.seriesUID if self.series is None else self.series.uid,
+            format=None if self.loader is None else self.loader.name, formatOptions=sorted(self.loaderOptions.items()))
+    
+    def loadFile(self, imageSize=(None,None), numberOfSlices=None, dataType='uint8', memoryMap=False, jobs=1, cache=None, brickSize=None):
+        """Loads the file or images containing the volume data into a numpy array. Raw files
+        and raw encoded nrrd files are opened as a read-only memory map if memoryMap is set.
+        Image slices are decoded by jobs processes, and with brickSize their brick grid is
+        reduced while they are read (see _readSlices). With an atlasTools.ConversionCache, a
+        previously loaded volume of the same files is opened from the cache instead."""
+        if not self.loaded and cache is not None:
+            key = self.cacheKey(cache, imageSize, numberOfSlices, dataType)
+            self.data = cache.loadVolume(key)
+            self.loaded = self.data is not None
+            if not self.loaded:
+                self.loadFile(imageSize, numberOfSlices, dataType, memoryMap, jobs, brickSize=brickSize)
+                cache.storeVolume(key, self.data)
         if not self.loaded:
-            if self.fileList:
-                if self.fileList[0].endswith('.dcm'):
-                    #Dicom files
-                    self.data = self._readDicom(self.fileList[0])
-                    for i in range(1, len(self.fileList)):
-                        self.data = np.dstack((self.data, self._readDicom(self.fileList[i])))
-                else:
-                    #Standard image extensions
-                    self.data = ndimage.imread(self.fileList[0], flatten=True)
-                    #Uses PIL to load the images
-                    for i in range(1, len(self.fileList)):
-                        self.data = np.dstack((self.data, ndimage.imread(self.fileList[i], flatten=True)))
-                self.loaded = True
-            else:
-                #Check by file extension
-                if self.fileExtension == '.nrrd':
-                    self._readNrrd()
+            with atlasTools.stage('load volume', atlasTools.fileBytes(self.fileList or [self.path])) as record:
+                startTime = time.time()
+                if self.loader is not None:
+                    #Registered slice format, in the order of its loader
+                    if not self.fileList:
+                        raise VolumeFileReaderException('No %s files found in %s!' % (self.loader.name, self.path))
+                    fileList = self.loader.selectSlices(self.fileList, self.loaderOptions, jobs)
+                    if not fileList:
+                        raise VolumeFileReaderException('Can not read the %s files!' % self.loader.name)
+                    self.fileList = fileList
+                    self._readSlices(self._readRegisteredImage, jobs, brickSize)
                     self.loaded = True
-                elif self.fileExtension == '.raw':
-                    if numberOfSlices != None and imageSize != None:
-                        self._readRaw(imageSize,numberOfSlices,dataType)
-                        self.loaded = True
+                elif self.fileList:
+                    if self.fileList[0].endswith('.dcm'):
+                        #Dicom files, in slice order
+                        if self.series is None:
+                            self.selectDicomSeries(self.seriesUID, jobs)
+                        self._readSlices(self._readDicom, jobs, brickSize)
                     else:
-                        raise VolumeFileReaderException('Image size and number of slices not specified!!')
+                        #Standard image extensions, uses PIL to load the images
+                        self._readSlices(self._readImage, jobs, brickSize)
+                    self.loaded = True
+                elif os.path.isdir(self.path):
+                    raise VolumeFileReaderException('No supported files found in %s, other slice formats are read with --plugin and --format' % self.path)
                 else:
-                    raise FormatException('Not supported file extension!')
-                    
+                    #Check by file extension
+                    if self.fileExtension == '.nrrd':
+                        self._readNrrd(memoryMap)
+                        self.loaded = True
+                    elif self.fileExtension == '.raw':
+                        if numberOfSlices != None and imageSize != None:
+                            if memoryMap:
+                                self._memoryMapRaw(imageSize,numberOfSlices,dataType)
+                            else:
+                                self._readRaw(imageSize,numberOfSlices,dataType)
+                            self.loaded = True
+                        else:
+                            raise VolumeFileReaderException('Image size and number of slices not specified!!')
+                    else:
+                        raise FormatException('Not supported file extension!')
+                elapsed = max(time.time() - startTime, 1e-6)
+                megaBytes = self.data.nbytes / (1024.0*1024.0)
+                action = 'Mapped' if memoryMap and isinstance(self.data, np.memmap) else 'Loaded'
+                print '%s %s volume (%.1f MB) in %.2f s, %.1f MB/s' % (action, str(self.data.shape), megaBytes, elapsed, megaBytes/elapsed)
+                record['bytesOut'] = self.data.nbytes
+
     def getVolumeDataInstance(self):
-        """Returns the loaded VolumeData instance."""
+        """Returns the loaded VolumeData instance, with the brick grid reduced while reading if any."""
         if self.loaded:
-            return VolumeData(self.data, 'nrrd')
+            volumeData = VolumeData(self.data, 'nrrd', self.header)
+            volumeData.brickSize, volumeData.brickMin, volumeData.brickMax = self.brickSize, self.brickMin, self.brickMax
+            return volumeData
     
 ################
 # Data Writing #
@@ -369,9 +697,13 @@ class VolumeFileWriter:
     """This class takes a VolumeData instance, and allows to save it in a file for various
     formats or as image slices"""
     
-    def __init__(self, volume_data):
-        """Class constructor"""
+    def __init__(self, volume_data, jobs=1, compressionLevel=6, pngFilter=None):
+        """Class constructor. The png images are encoded by jobs threads with a zlib compression
+        level and a png filter (see atlasTools.encodePNG)"""
         self.volumeData = volume_data
+        self.jobs = jobs
+        self.compressionLevel = compressionLevel
+        self.pngFilter = pngFilter
         
     def _checkOutputDirPath(self, path):
         """Checks if the path contains a folder. If not, it is created"""
@@ -385,16 +717,40 @@ class VolumeFileWriter:
         except:
             print 'Could not create folder, trying to write anyways..'
     
-    def _saveImage(self, imageArray, path, name, resolution=None, mode=None, f_format='.png'):
-        """Saves a 2D numpy array into an image file format."""
-        try:
-            if resolution == None:
-                resolution = (imageArray.shape[0],imageArray.shape[1])                
-            self._checkOutputDirPath(path)
-            atlasImg = misc.toimage(imageArray, mode=mode)            
-            atlasImg.save(path+name+f_format)
-        except FormatException:
-            print 'Not valid operation!'
+    @staticmethod
+    def _arraysBytes(*ndarrays):
+        """Returns the total size in bytes of the arrays that are not None, the input of a saving stage"""
+        return sum(ndarray.nbytes for ndarray in ndarrays if ndarray is not None)
+    
+    @staticmethod
+    def _quantizedSlices(ndarray):
+        """Yields the slices of a (X, Y, Z) or (X, Y, Z, C) numpy array as uint8 values, scaled from the
+        value range of its atlas as misc.toimage does. This is the only quantization done to the data."""
+        cmin, cmax = atlasTools.atlasRange(ndarray)
+        for i in range(ndarray.shape[2]):
+            yield atlasTools.byteScale(ndarray[:,:,i], cmin, cmax)
+    
+    def _saveAtlas(self, ndarray, path, name, mode=None, f_format='.png', stream=False):
+        """Saves the atlas of a (X, Y, Z) or (X, Y, Z, C) numpy array into an image file format. With stream
+        the png image is written one row of slices at a time instead of building the whole atlas."""
+        self._checkOutputDirPath(path)
+        if stream and f_format == '.png':
+            failed = atlasTools.writeAtlasStreaming(self._quantizedSlices(ndarray), ndarray.shape[2], path+name, dimensions=[], fullSuffix='',
+                compressionLevel=self.compressionLevel, pngFilter=self.pngFilter)
+            if failed:
+                raise IOError('Could not write '+', '.join(failed))
+        elif f_format == '.png' and mode is None:
+            self._savePNGAtlases([ndarray], [path+name])
+        else:
+            atlas = atlasTools.tileSlices(self._quantizedSlices(ndarray), ndarray.shape[2])
+            Image.fromarray(atlas, mode).save(path+name+f_format)
+    
+    def _savePNGAtlases(self, ndarrays, filenames):
+        """Saves the atlases of numpy arrays as png files (filenames without extension), encoded at the same time"""
+        atlases = [atlasTools.tileSlices(self._quantizedSlices(ndarray), ndarray.shape[2]) for ndarray in ndarrays]
+        failed = atlasTools.saveImagesParallel(atlases, [filename+'.png' for filename in filenames], self.jobs, self.compressionLevel, self.pngFilter)
+        if failed:
+            raise IOError('Could not write '+', '.join(failed))
     
     def _saveAsImageSlices(self, ndarray, path, name, resolution=None, mode=None, f_format='.png'):
         """Saves each slice from a numpy array as an image"""
@@ -409,32 +765,202 @@ class VolumeFileWriter:
             print 'Warning, could not save image slices!'
             return -1
             
-    def saveAtlas(self, path, name, resolution=None, mode=None, f_format=".png"):
-        """Save the volume data atlas into a image"""
-        self._saveImage(self.volumeData.getAtlas(), path+name+'_atlas/', name, resolution, mode, f_format)
+    def saveAtlas(self, path, name, resolution=None, mode=None, f_format=".png", stream=False):
+        """Save the volume data atlas into a image. With stream the png image is written one row of slices at a time"""
+        self._saveAtlas(self.volumeData.data, path+name+'_atlas/', name, mode, f_format, stream)
+    
+    def saveGradientAtlas(self, path, name, resolution=None, mode=None, f_format=".png", stream=False):
+        """Save the gradient data into a image. With stream the png image is written one row of slices at a time.
+        If the gradient magnitude was calculated, it is saved in the alpha channel of a RGBA image."""
+        if self.volumeData.gradientRGBA is not None:
+            self._saveAtlas(self.volumeData.gradientRGBA, path+name+'_atlas/', name+'_gradient', mode, f_format, stream)
+        elif self.volumeData.gradient is not None:
+            self._saveAtlas(self.volumeData.gradient, path+name+'_atlas/', name+'_gradient', mode, f_format, stream)
+        else:
+            print 'The gradient must be previously computed!'
+    
+    def saveAtlases(self, path, name, stream=False):
+        """Save the volume data and gradient atlases into png images. Without stream both atlases
+        are encoded at the same time (see saveAtlas and saveGradientAtlas)."""
+        gradient = self.volumeData.gradient if self.volumeData.gradientRGBA is None else self.volumeData.gradientRGBA
+        with atlasTools.stage('save atlases', self._arraysBytes(self.volumeData.data, gradient)) as record:
+            if stream or gradient is None:
+                self.saveAtlas(path, name, stream=stream)
+                self.saveGradientAtlas(path, name, stream=stream)
+            else:
+                self._checkOutputDirPath(path+name+'_atlas/')
+                self._savePNGAtlases([self.volumeData.data, gradient], [path+name+'_atlas/'+name, path+name+'_atlas/'+name+'_gradient'])
+            record['bytesOut'] = atlasTools.fileBytes([path+name+'_atlas/'+name+'.png', path+name+'_atlas/'+name+'_gradient.png'])
     
-    def saveGradientAtlas(self, path, name, resolution=None, mode=None, f_format=".png"):
-        """Save the gradient data into a image"""
-        self._saveImage(self.volumeData.getGradientAtlas(), path+name+'_atlas/', name+'_gradient', resolution, mode, f_format)
+    def saveLevelsOfDetail(self, path, name, levels, jobs=1):
+        """Save levels of detail of the volume data and gradient atlases. Each level is halved along X, Y and Z
+        from the previous one and saved as its own atlas, with its atlas dimensions file."""
+        path = path+name+'_atlas/'
+        self._checkOutputDirPath(path)
+        gradient = self.volumeData.gradient if self.volumeData.gradientRGBA is None else self.volumeData.gradientRGBA
+        with atlasTools.stage('save levels of detail', self._arraysBytes(self.volumeData.data, gradient)) as record:
+            failed = atlasTools.writeLevelsOfDetail(atlasTools.halveSlices(self._quantizedSlices(self.volumeData.data)), path+name, levels, jobs, self.compressionLevel, self.pngFilter)
+            if gradient is not None:
+                failed += atlasTools.writeLevelsOfDetail(atlasTools.halveSlices(self._quantizedSlices(gradient)), path+name+'_gradient', levels, jobs, self.compressionLevel, self.pngFilter)
+            record['bytesOut'] = atlasTools.fileBytes([path+name+suffix+'_lod'+str(level)+'.png' for suffix in ('', '_gradient')
+                for level in range(1, levels+1) if path+name+suffix+'_lod'+str(level)+'.png' not in failed])
+        for filename in failed:
+            print 'Could not write '+filename
     
     def saveDataSlices(self, path, name, resolution=None, f_format=".png"):
         """Save each volume and gradient data slices into images"""
-        if self.volumeData.data != None:
-            self._saveAsImageSlices(self.volumeData.data, path+name+"_slices/data/", name, resolution, None, f_format)
-        if self.volumeData.gradient != None:
-            self._saveAsImageSlices(self.volumeData.gradient, path+name+"_slices/gradient/", name, resolution, "RGB", f_format)
+        with atlasTools.stage('save data slices', self._arraysBytes(self.volumeData.data, self.volumeData.gradient)) as record:
+            filenames = []
+            if self.volumeData.data is not None:
+                self._saveAsImageSlices(self.volumeData.data, path+name+"_slices/data/", name, resolution, None, f_format)
+                filenames += [path+name+"_slices/data/"+name+("%04d" % i)+f_format for i in range(self.volumeData.data.shape[2])]
+            if self.volumeData.gradient is not None:
+                self._saveAsImageSlices(self.volumeData.gradient, path+name+"_slices/gradient/", name, resolution, "RGB", f_format)
+                filenames += [path+name+"_slices/gradient/"+name+("%04d" % i)+f_format for i in range(self.volumeData.gradient.shape[2])]
+            record['bytesOut'] = atlasTools.fileBytes(filenames)
+    
+    def saveBrickGrid(self, path, name):
+        """Save the brick grid of the volume data (see VolumeData.calculateBricks) as a small RGB atlas
+        path+name+'_atlas/'+name+'_bricks.png', one tile per brick slice with the minimum of each brick in
+        the red channel and its maximum in the green one. The values are quantized as the volume atlas
+        is, so every atlas value of a brick lies in its [red, green] range. The grid is described in
+        the JSON file name+'_bricks.json' next to it."""
+        volumeData = self.volumeData
+        if volumeData.brickMin is None:
+            print 'The brick grid must be previously computed!'
+            return
+        path = path+name+'_atlas/'
+        self._checkOutputDirPath(path)
+        #The value range of the volume atlas, including its empty tiles (see atlasTools.atlasRange)
+        cmin, cmax = volumeData.brickMin.min(), volumeData.brickMax.max()
+        if atlasTools.slicesPerAxis(volumeData.data.shape[2])**2 > volumeData.data.shape[2]:
+            cmin, cmax = min(cmin, 0), max(cmax, 0)
+        grid = np.zeros(volumeData.brickMin.shape+(3,), dtype=np.uint8)
+        grid[...,0] = atlasTools.byteScale(volumeData.brickMin, cmin, cmax)
+        grid[...,1] = atlasTools.byteScale(volumeData.brickMax, cmin, cmax)
+        atlas = atlasTools.tileSlices((grid[:,:,i] for i in range(grid.shape[2])), grid.shape[2])
+        failed = atlasTools.saveImagesParallel([atlas], [path+name+'_bricks.png'], 1, self.compressionLevel, self.pngFilter)
+        if failed:
+            raise IOError('Could not write '+', '.join(failed))
+        perAxis = atlasTools.slicesPerAxis(grid.shape[2])
+        with open(path+name+'_bricks.json', 'w') as f:
+            json.dump({'atlas':name+'_bricks.png', 'brickSize':volumeData.brickSize, 'volumeShape':list(volumeData.data.shape[:3]),
+                'gridShape':list(grid.shape[:3]), 'numberOfSlices':grid.shape[2], 'slicesOverX':perAxis, 'slicesOverY':perAxis,
+                'channels':{'red':'minimum', 'green':'maximum'}, 'valueRange':[float(cmin), float(cmax)],
+                'emptyBricks':int((grid[...,1] == 0).sum()), 'cropOffset':volumeData.cropOffset}, f, indent=1, sort_keys=True)
+    
+    def saveDistanceField(self, path, name):
+        """Save the distance field of the volume data (see VolumeData.calculateDistanceField) as the small
+        grayscale atlas path+name+'_atlas/'+name+'_distance.png', one tile per brick slice, with its
+        name+'_distance_AtlasDim.txt' dimensions file and its JSON description name+'_distance.json'"""
+        volumeData = self.volumeData
+        if volumeData.distanceField is None:
+            print 'The distance field must be previously computed!'
+            return
+        path = path+name+'_atlas/'
+        self._checkOutputDirPath(path)
+        distance = volumeData.distanceField
+        atlas = atlasTools.tileSlices((distance[:,:,i] for i in range(distance.shape[2])), distance.shape[2])
+        failed = atlasTools.saveImagesParallel([atlas], [path+name+'_distance.png'], 1, self.compressionLevel, self.pngFilter)
+        if failed:
+            raise IOError('Could not write '+', '.join(failed))
+        atlasTools.writeAtlasDim(path+name+'_distance_AtlasDim.txt', distance.shape[2], name+'_distance.png')
+        perAxis = atlasTools.slicesPerAxis(distance.shape[2])
+        with open(path+name+'_distance.json', 'w') as f:
+            json.dump({'atlas':name+'_distance.png', 'metric':'chessboard', 'units':'bricks', 'maxDistance':255,
+                'brickSize':volumeData.brickSize, 'threshold':float(volumeData.distanceThreshold), 'volumeShape':list(volumeData.data.shape[:3]),
+                'gridShape':list(distance.shape), 'numberOfSlices':distance.shape[2], 'slicesOverX':perAxis, 'slicesOverY':perAxis,
+                'emptyBricks':int((distance > 0).sum()), 'cropOffset':volumeData.cropOffset}, f, indent=1, sort_keys=True)
     
     @staticmethod
-    def saveArrayAsNrrd(): #TODO
-        pass
+    def _binaryRange(ndarray, dtype):
+        """Returns the value range of a numpy array scaled to the range of an unsigned integer dtype,
+        or None if the array has integer values that fit in dtype and are kept"""
+        cmin, cmax = ndarray.min(), ndarray.max()
+        if ndarray.dtype.kind in 'ui' and cmin >= 0 and cmax <= np.iinfo(dtype).max:
+            return None
+        return float(cmin), float(cmax)
+    
+    @staticmethod
+    def _binarySlices(ndarray, dtype, valueRange, swapAxes=False):
+        """Yields the slices of a (X, Y, Z) or (X, Y, Z, C) numpy array as little endian dtype values, scaled
+        from valueRange (see _binaryRange). With swapAxes the X and Y axes of each slice are swapped."""
+        top = np.iinfo(dtype).max
+        for i in range(ndarray.shape[2]):
+            data = ndarray[:,:,i]
+            if valueRange is not None:
+                cmin, cmax = valueRange
+                data = ((data - cmin) * (top / ((cmax - cmin) or 1.0))).clip(0, top) + 0.5
+            data = data.astype(np.dtype(dtype).newbyteorder('<'))
+            yield np.ascontiguousarray(data.swapaxes(0, 1) if swapAxes else data)
+    
+    @staticmethod
+    def _writeBinary(ndarray, filename, header, dtype, compress, swapAxes=False, nrrdHeader=''):
+        """Writes the binary slices of a numpy array after an optional nrrd header, gzip compressed
+        with compress, and its JSON header filename+'.json'. The dataOffset of the header is the
+        position of the data (of the gzip stream when compressed) in the file. Returns the header dictionary."""
+        valueRange = VolumeFileWriter._binaryRange(ndarray, dtype)
+        channels = ndarray.shape[3] if ndarray.ndim > 3 else 1
+        header.update({'file':os.path.basename(filename), 'encoding':'gzip' if compress else 'raw',
+            'type':np.dtype(dtype).name, 'endian':'little', 'channels':channels, 'shape':list(ndarray.shape[:3]),
+            'valueRange':valueRange, 'dataOffset':len(nrrdHeader),
+            'bytes':int(np.prod(ndarray.shape))*np.dtype(dtype).itemsize})
+        startTime = time.time()
+        with open(filename, 'wb') as f:
+            f.write(nrrdHeader)
+            out = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) if compress else f
+            for data in VolumeFileWriter._binarySlices(ndarray, dtype, valueRange, swapAxes):
+                out.write(data.tostring())
+            if compress:
+                out.close()
+            size = f.tell()
+        with open(filename+'.json', 'w') as f:
+            json.dump(header, f, indent=1, sort_keys=True)
+        print 'Saved %s: %d bytes in %.2f s' % (filename, size, time.time()-startTime)
+        return header
+    
+    @staticmethod
+    def saveArrayAsNrrd(ndarray, filename, dtype='uint8', compress=False):
+        """Saves a (X, Y, Z) or (X, Y, Z, C) numpy array as a nrrd file of dtype (uint8 or uint16) values,
+        with gzip encoding if compress. The values are stored X fastest (channels interleaved), so reading
+        the file gives back the same array. Also writes its JSON header filename+'.json'."""
+        channels = ndarray.shape[3] if ndarray.ndim > 3 else 1
+        sizes = ([channels] if ndarray.ndim > 3 else []) + list(ndarray.shape[:3])
+        kinds = ([{3:'RGB-color', 4:'RGBA-color'}.get(channels, 'vector')] if ndarray.ndim > 3 else []) + ['domain']*3
+        nrrdHeader = 'NRRD0004\n# Saved by the Gradient Atlas Generator\ntype: %s\ndimension: %d\nsizes: %s\nkinds: %s\nendian: little\nencoding: %s\n\n' % \
+            (np.dtype(dtype).name, len(sizes), ' '.join(map(str, sizes)), ' '.join(kinds), 'gzip' if compress else 'raw')
+        header = {'format':'nrrd', 'sizes':list(ndarray.shape[:3]),
+            'layout':'channels interleaved, then X (fastest), Y and Z (slowest) after the nrrd header'}
+        return VolumeFileWriter._writeBinary(ndarray, filename, header, dtype, compress, True, nrrdHeader)
     
     @staticmethod
     def saveArrayAsDicom(): #TODO
         pass
     
     @staticmethod
-    def saveArrayAsRaw(): #TODO
-        pass
+    def saveArrayAsRaw(ndarray, filename, dtype='uint8', compress=False):
+        """Saves a (X, Y, Z) or (X, Y, Z, C) numpy array as contiguous dtype (uint8 or uint16) values, gzip
+        compressed if compress. Each slice is stored as the rows of its atlas tile, Y fastest (channels
+        interleaved), which is the texture layout of texImage3D and the layout read with --size.
+        Also writes its JSON header filename+'.json'."""
+        header = {'format':'raw', 'sizes':[ndarray.shape[1], ndarray.shape[0], ndarray.shape[2]],
+            'layout':'channels interleaved, then Y (fastest), X and Z (slowest)'}
+        return VolumeFileWriter._writeBinary(ndarray, filename, header, dtype, compress)
+    
+    def saveBinary(self, path, name, f_format='.raw', dtype='uint8', compress=False):
+        """Save the volume data and gradient as binary files (see saveArrayAsRaw and saveArrayAsNrrd) in
+        the path+name+'_binary/' folder, each one with a JSON header. The gradient magnitude, if calculated,
+        is saved as a fourth channel."""
+        path = path+name+'_binary/'
+        self._checkOutputDirPath(path)
+        saveArray = VolumeFileWriter.saveArrayAsNrrd if f_format == '.nrrd' else VolumeFileWriter.saveArrayAsRaw
+        extension = f_format+('.gz' if compress and f_format == '.raw' else '')
+        with atlasTools.stage('save binary') as record:
+            saveArray(self.volumeData.data, path+name+extension, dtype, compress)
+            gradient = self.volumeData.gradient if self.volumeData.gradientRGBA is None else self.volumeData.gradientRGBA
+            if gradient is not None:
+                saveArray(gradient, path+name+'_gradient'+extension, dtype, compress)
+            record['bytesOut'] = atlasTools.fileBytes([path+name+extension, path+name+'_gradient'+extension])
     
     def saveFileInformation(self, path, name='_AtlasDim.txt'):
         """Save information about the volume data"""
@@ -452,6 +978,18 @@ class VolumeFileWriter:
         except:
             print 'Error!, could not write information text file '+ name
     
+    def saveCropInformation(self, path, name):
+        """Save the offset and size (width, height, slices) of the cropped volume data in the original
+        one as path+name+'_crop.json', in the format of the converter scripts (see atlasTools.writeCropFile)"""
+        if self.volumeData.cropOffset is None:
+            return
+        box = tuple((start, start+size) for start, size in zip(self.volumeData.cropOffset, self.volumeData.data.shape[:3]))
+        try:
+            self._checkOutputDirPath(path)
+            atlasTools.writeCropFile(path+name+'_crop.json', box)
+        except:
+            print 'Error!, could not write the crop file '+path+name+'_crop.json'
+    
 ######################################
 # Main program - CLI with argparse - #
 ######################################
@@ -465,6 +1003,7 @@ data slices into a tiled 2D texture image in PNG format (it assumes all files
 in the folder are of the same type and dimensions).
 It requires Python with PIL, numpy, matplolib and ndimage packages. 
 pydicom and pynrrd packages are needed for dicom and nrrd file type formats.
+atlasTools.py must be in the same folder.
 
 The code was created by Ander Arbelaiz based on Luis Kabongo's atlas converson
 tool. Vicomtech-IK4 Copyright 2014-2015.
@@ -478,24 +1017,103 @@ Contact mailto:volumerendering@vicomtech.org ''')
     parser.add_argument('outputname', type=str, help='The output file(s) base name')
     parser.add_argument('--size', type=int, nargs=3, metavar=('x','y','z'), help='Size of input images x y z, only specify with raw files. The third value (z) is the number of slices')
     parser.add_argument('--dtype', type=str, default='uint8', help='The data type')    
+    parser.add_argument('--series', type=str, default=None, metavar='UID', help='SeriesInstanceUID of the dicom series to load, by default the one with more slices')
+    parser.add_argument('--plugin', type=str, action='append', default=[], metavar='MODULE', help='Python module (or .py file) registering a slice loader with atlasTools.registerLoader, e.g. convertRAW or a copy of convertMyData.py. Can be repeated')
+    parser.add_argument('--format', type=str, default=None, metavar='NAME', help='Read every file of the input folder with this registered slice format, e.g. RAW (--plugin convertRAW) or DATA (--plugin convertMyData.py). Needed for the formats without file extensions')
+    parser.add_argument('--format-option', type=str, action='append', default=[], metavar='KEY=VALUE', help='Option of the --format slice format, e.g. --format-option width=256 for RAW. Can be repeated')
+    parser.add_argument('--mmap', action='store_true', help='Open raw and raw encoded nrrd files as a read-only memory map instead of loading them in memory')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes used to decode the image slices and to calculate the gradient')
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'float64'], help='The floating point precision used to calculate the gradient')
+    parser.add_argument('--slab', type=int, default=None, help='Calculate the gradient in blocks of this number of slices')
+    parser.add_argument('--magnitude', action='store_true', help='Also calculate the gradient magnitude and save it in the alpha channel of the gradient atlas')
+    parser.add_argument('--cache', type=str, default=None, metavar='DIR', help='Reuse the output files, or the loaded volume, of previous runs with the same input and parameters kept in this folder')
+    parser.add_argument('--cache-size', type=float, default=4096, metavar='MB', help='Maximum size of the cache, the least recently used entries are removed')
+    parser.add_argument('--cache-hash', action='store_true', help='Identify the input files of the cache by their contents instead of their modification time')
+    parser.add_argument('--cache-gradient', action='store_true', help='Also keep the calculated gradient in the cache, reopened as a memory map by later runs with the same method and precision')
+    parser.add_argument('--lod', type=int, default=0, help='Also save this number of levels of detail, each one halved along x, y and z')
     parser.add_argument('--slices', '-l', action='store_true')
     parser.add_argument('--not_atlas', '-na', action='store_true')
+    parser.add_argument('--stream', action='store_true', help='Write the atlas images one row of slices at a time instead of building them in memory')
+    parser.add_argument('--crop', type=float, default=None, metavar='VALUE', help='Crop the volume to the bounding box of the voxels above this value before calculating the gradient, its offset and size (width, height, slices) are written in <outputname>_crop.json')
+    parser.add_argument('--bricks', type=int, default=None, metavar='N', help='Also save the minimum and maximum of each NxNxN brick of voxels (e.g. 8 or 16) as a small atlas with a JSON file, to skip the empty space when rendering')
+    parser.add_argument('--distance-field', action='store_true', help='Also save the Chebyshev distance (in bricks of --bricks voxels, 8 by default) from each brick to the nearest non-empty one as a small atlas, for ray marching with longer steps in empty space')
+    parser.add_argument('--distance-threshold', type=float, default=None, metavar='VALUE', help='Voxels above this value are non-empty in the distance field, by default those above the minimum of the volume')
+    parser.add_argument('--png-level', type=int, default=6, choices=range(10), help='zlib compression level of the png images, from 0 (fastest) to 9 (smallest)')
+    parser.add_argument('--png-filter', type=str, default=None, choices=['none', 'sub', 'up', 'adaptive'], help='png row filter, adaptive by default (up with --stream)')
     #parser.add_argument('--resolution', '-r', type=str, default='full', choices=['4096','2048','1024','512','256'], help='The ouptut atlas resolution, if not specified all resolutions will be used')
     parser.add_argument('--method', '-m', type=str, default='gauss', choices=['gauss','sobel','prewitt','central-differences', 'forward-differences'], help='The method used to generate the gradient.')    
-    #parser.add_argument('--saveAs', '-s', type=str, default=None, choices=['.nrrd','.dicom','.raw'], help='Save the computed volume gradient into a file')    
+    parser.add_argument('--saveAs', '-s', type=str, default=None, choices=['.nrrd','.dicom','.raw'], help='Save the volume and computed gradient into binary files, with a JSON header each')    
+    parser.add_argument('--binary-dtype', type=str, default='uint8', choices=['uint8', 'uint16'], help='The data type of the --saveAs files')
+    parser.add_argument('--gzip', action='store_true', help='Compress the --saveAs files with gzip')
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE', help='Print the time, CPU, bytes and peak memory of each stage and write them to this file as JSON')
+    parser.add_argument('--profile-dump', type=str, default=None, metavar='FILE', help='Write the cProfile statistics of the run to this file (see the pstats module)')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1b')
 
     #Obtain the parsed arguments
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv[1:] if argv is not None else None)
+    return atlasTools.runProfiled(lambda: generate(arguments), arguments.profile, arguments.profile_dump)
+
+def generate(arguments):
+    """Loads the volume, calculates its gradient and saves the output files given by the parsed
+    command line arguments (see main). Returns the exit status (None on success)."""
     print 'Step 1/3 Reading the volume data' 
-    volume = VolumeFileReader(arguments.input)
+    for plugin in arguments.plugin:
+        #The loader modules register their slice format when imported
+        if plugin.endswith('.py'):
+            sys.path.insert(0, os.path.dirname(os.path.abspath(plugin)))
+            plugin = os.path.basename(plugin)[:-3]
+        __import__(plugin)
+    loader, loaderOptions = None, {}
+    if arguments.format_option and arguments.format is None:
+        print 'The --format-option options need the slice format given with --format'
+        return -1
+    if arguments.format is not None:
+        if arguments.format not in atlasTools.sliceLoaders:
+            print 'Unknown slice format %s, the registered formats are: %s (see --plugin)' % (arguments.format, ', '.join(sorted(atlasTools.sliceLoaders)) or 'none')
+            return -1
+        loader = atlasTools.sliceLoaders[arguments.format]
+        try:
+            loaderOptions = loader.parseOptions(option.partition('=')[::2] for option in arguments.format_option)
+        except ValueError as e:
+            print str(e)
+            return -1
+    volume = VolumeFileReader(arguments.input, loader, loaderOptions)
+    imageSize, numberOfSlices = ((arguments.size[0],arguments.size[1]), arguments.size[2]) if arguments.size else ((None,None), None)
+    #The dicom files are grouped by series and ordered reading only their headers when the volume is not cached
+    volume.seriesUID = arguments.series
+    #Reuse the cached output files if the same input was processed with the same parameters
+    cache, gradientKey = None, None
+    if arguments.cache:
+        cache = atlasTools.ConversionCache(arguments.cache, arguments.cache_size, arguments.cache_hash)
+        volumeKey = volume.cacheKey(cache, imageSize, numberOfSlices, arguments.dtype)
+        if arguments.cache_gradient:
+            gradientKey = cache.key(volume.fileList or [arguments.input], volume=volumeKey, method=arguments.method, magnitude=arguments.magnitude, precision=arguments.precision, crop=arguments.crop)
+        outputsKey = cache.key(volume.fileList or [arguments.input], volume=volumeKey,
+            output=arguments.outputname, method=arguments.method, magnitude=arguments.magnitude, precision=arguments.precision,
+            lod=arguments.lod, slices=arguments.slices, not_atlas=arguments.not_atlas, pngLevel=arguments.png_level, pngFilter=arguments.png_filter,
+            saveAs=arguments.saveAs, binaryType=arguments.binary_dtype, gzip=arguments.gzip, crop=arguments.crop, bricks=arguments.bricks,
+            distanceField=arguments.distance_field, distanceThreshold=arguments.distance_threshold)
+        if cache.restoreOutputs(outputsKey, arguments.outputdir):
+            return 0
     #Try loading the volume file or image slices
     try:
-        if arguments.size and arguments.dtype:
-            volume.loadFile((arguments.size[1],arguments.size[1]), arguments.size[2], arguments.dtype)
-        else:
-            volume.loadFile()
+        #The brick grid of the distance field is 8 voxels wide by default (see VolumeData.calculateDistanceField)
+        volume.loadFile(imageSize, numberOfSlices, arguments.dtype, arguments.mmap, arguments.jobs, cache,
+            arguments.bricks or (8 if arguments.distance_field else None))
         volumeData = volume.getVolumeDataInstance()
+        if arguments.crop is not None:
+            box = volumeData.cropToBoundingBox(arguments.crop)
+            if box is None:
+                print 'No voxel above the crop value %g, the volume is not cropped' % arguments.crop
+            else:
+                print 'Cropped the volume to the bounding box (start, end) along the width, height and slices: %s' % str((box[1], box[0], box[2]))
+        if arguments.bricks:
+            volumeData.calculateBricks(arguments.bricks)
+        if arguments.distance_field:
+            volumeData.calculateDistanceField(arguments.distance_threshold)
+    except VolumeFileReaderException as e:
+        print 'Error while loading the volume data! '+str(e)
+        return -1
     except:
         print 'Error while loading the volume data!'
         return -1
@@ -503,8 +1121,17 @@ Contact mailto:volumerendering@vicomtech.org ''')
     #Calculate the gradient from the volumedata
     print 'Step 2/3 Calculating the gradient...'
     try:
-        volumeData.calculateGradientRGB(arguments.method)
-        volumeData.calculateGradientMagnitudeRGB(arguments.method)
+        gradient = cache.loadVolume(gradientKey, 'gradient') if gradientKey else None
+        if gradient is not None:
+            volumeData.setGradient(gradient)
+        elif arguments.magnitude:
+            volumeData.calculateGradientMagnitudeRGB(arguments.method, arguments.slab, arguments.jobs, np.dtype(arguments.precision))
+        else:
+            volumeData.calculateGradientRGB(arguments.method, arguments.slab, arguments.jobs, np.dtype(arguments.precision))
+        if gradientKey and gradient is None:
+            cache.storeVolume(gradientKey, volumeData.gradient if volumeData.gradientRGBA is None else volumeData.gradientRGBA, 'gradient')
+        if atlasTools.peakMemoryMB() is not None:
+            print 'Gradient calculated, peak memory use %.0f MB' % atlasTools.peakMemoryMB()
     except:
         print 'Error while calculating the gradient..'
         return -1
@@ -512,16 +1139,27 @@ Contact mailto:volumerendering@vicomtech.org ''')
     #Saving the atlas from the volumedata
     print 'Step 3/3 Saving the output file(s)...'
     try:
-        volumeWriter = VolumeFileWriter(volumeData)
+        volumeWriter = VolumeFileWriter(volumeData, arguments.jobs, arguments.png_level, arguments.png_filter)
         
         if arguments.not_atlas == False:
-            volumeWriter.saveAtlas(arguments.outputdir, arguments.outputname)
-            volumeWriter.saveGradientAtlas(arguments.outputdir, arguments.outputname)
+            volumeWriter.saveAtlases(arguments.outputdir, arguments.outputname, stream=arguments.stream)
+            if arguments.lod > 0:
+                volumeWriter.saveLevelsOfDetail(arguments.outputdir, arguments.outputname, arguments.lod, arguments.jobs)
             volumeWriter.saveFileInformation(arguments.outputdir)
+        if volumeData.cropOffset is not None:
+            volumeWriter.saveCropInformation(arguments.outputdir, arguments.outputname)
+        if arguments.bricks:
+            volumeWriter.saveBrickGrid(arguments.outputdir, arguments.outputname)
+        if arguments.distance_field:
+            volumeWriter.saveDistanceField(arguments.outputdir, arguments.outputname)
         if arguments.slices:
             volumeWriter.saveDataSlices(arguments.outputdir, arguments.outputname)
-        if arguments.saveAs != None:
+        if arguments.saveAs == '.dicom':
             print 'NIY!'
+        elif arguments.saveAs != None:
+            volumeWriter.saveBinary(arguments.outputdir, arguments.outputname, arguments.saveAs, arguments.binary_dtype, arguments.gzip)
+        if cache is not None:
+            cache.storeOutputs(outputsKey, arguments.outputdir, [arguments.outputname, '_AtlasDim.txt'])
     except:
         print 'Sorry :(, error while saving the ouput file(s)!'
         return -1